@@ -5,6 +5,27 @@ Matches NCES County ID to county GeoJSON GEOID10 field.
 """
 
 import json
+import ijson
+import orjson
+
+
+def add_county_feature(county_lookup, feature):
+    """Index a county feature by its GEOID10 property."""
+    geoid = feature.get('properties', {}).get('GEOID10')
+    if geoid:
+        county_lookup[geoid] = feature
+
+
+def write_districts(districts, output_file):
+    """Write districts one entry at a time so only one serialized district is held in memory."""
+    with open(output_file, 'wb') as f:
+        f.write(b'{')
+        for i, (district_name, district_data) in enumerate(districts.items()):
+            f.write(b',\n' if i else b'\n')
+            f.write(orjson.dumps(district_name))
+            f.write(b':')
+            f.write(orjson.dumps(district_data))
+        f.write(b'\n}\n')
 
 
 def main():
@@ -13,29 +34,28 @@ def main():
     school_districts_file = 'data/school_districts.json'
     output_file = 'data/school_districts.json'
 
-    # Load county GeoJSON
+    # Stream county GeoJSON features into a lookup dictionary: GEOID10 -> feature
     print("Loading county GeoJSON data...")
+    county_lookup = {}
     try:
-        with open(county_geojson_file, 'r', encoding='utf-8') as f:
-            county_data = json.load(f)
-    except UnicodeDecodeError:
+        with open(county_geojson_file, 'rb') as f:
+            for feature in ijson.items(f, 'features.item', use_float=True):
+                add_county_feature(county_lookup, feature)
+    except (ijson.JSONError, UnicodeDecodeError):
+        # ijson only accepts UTF-8, so fall back to the stdlib for latin-1 files
         print("UTF-8 encoding failed, trying latin-1...")
+        county_lookup = {}
         with open(county_geojson_file, 'r', encoding='latin-1') as f:
             county_data = json.load(f)
-
-    # Create a lookup dictionary: GEOID10 -> feature
-    county_lookup = {}
-    for feature in county_data.get('features', []):
-        geoid = feature.get('properties', {}).get('GEOID10')
-        if geoid:
-            county_lookup[geoid] = feature
+        for feature in county_data.get('features', []):
+            add_county_feature(county_lookup, feature)
 
     print(f"Loaded {len(county_lookup)} county features")
 
     # Load school districts data
     print("Loading school districts data...")
-    with open(school_districts_file, 'r', encoding='utf-8') as f:
-        districts = json.load(f)
+    with open(school_districts_file, 'rb') as f:
+        districts = orjson.loads(f.read())
 
     # Match and add county GeoJSON to districts
     matched_count = 0
@@ -67,8 +87,7 @@ def main():
 
     # Write updated data back to file
     print(f"\nWriting updated data to {output_file}...")
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(districts, f, indent=2, ensure_ascii=False)
+    write_districts(districts, output_file)
 
     # Summary
     print(f"\n=== Summary ===")
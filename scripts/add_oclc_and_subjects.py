@@ -4,15 +4,51 @@ OCLC and Subjects Addition Script
 Searches WorldCat by ISBN for books without OCLC numbers and populates metadata.
 """
 
-import json
+import logging
 import os
+import orjson
+import re
 import requests
+import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
+from books_journal import BOOKS_FILE, append_update, apply_updates, close_journal, load_books
+from http_utils import rate_limiter_for
+
+
+log = logging.getLogger(__name__)
+
+UPDATES_FILE = 'data/books_by_title.add_oclc_and_subjects.updates.jsonl'
+WORLDCAT_CACHE_DIR = 'data/.worldcat_cache'
+
+# Maximum number of concurrent WorldCat requests
+MAX_WORKERS = 8
+
+# Be nice to the OCLC API - same cap as get_holdings_count.py, across all workers
+REQUESTS_PER_SECOND = 5
+
+# Shared session so every request reuses pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=32))
+rate_limiter = rate_limiter_for('americas.discovery.api.oclc.org', REQUESTS_PER_SECOND)
+
+# Roles that disqualify a person from being a "creator only"
+NON_CREATOR_ROLES = frozenset({
+    'editor', 'compiler', 'voice actor', 'ed.lit', 'mitwirkender',
+    'buchgestalter', 'herausgeber', 'drucker', 'buchbinder', 'issuing body',
+    'hörfunkproduzent', 'verlag', 'regisseur', 'synchronsprecher', 'narrator'
+})
+
+# Anything that cannot appear in an ISBN
+_ISBN_RE = re.compile(r'[^0-9Xx]')
 
 # Global variables for authentication
 headers = {}
 auth_timestamp = None
+auth_lock = threading.Lock()
 
 
 def reauth(oclc_client_id, oclc_secret):
@@ -20,37 +56,45 @@ def reauth(oclc_client_id, oclc_secret):
     global headers
     global auth_timestamp
 
-    if auth_timestamp is not None:
-        sec_left = time.time() - auth_timestamp
-        sec_left = 1199 - 1 - int(sec_left)
+    # Worker threads share one token, so only one of them refreshes it at a time
+    with auth_lock:
+        if auth_timestamp is not None:
+            sec_left = time.time() - auth_timestamp
+            sec_left = 1199 - 1 - int(sec_left)
 
-        if sec_left > 60:
-            return True
+            if sec_left > 60:
+                return True
 
-    print("[VERBOSE] Authenticating with OCLC...")
-    response = requests.post(
-        'https://oauth.oclc.org/token',
-        data={"grant_type": "client_credentials", 'scope': ['wcapi']},
-        auth=(oclc_client_id, oclc_secret),
-    )
+        log.debug("Authenticating with OCLC...")
+        response = SESSION.post(
+            'https://oauth.oclc.org/token',
+            data={"grant_type": "client_credentials", 'scope': ['wcapi']},
+            auth=(oclc_client_id, oclc_secret),
+        )
 
-    print(f"[VERBOSE] Auth response: {response.text}")
+        log.debug("Auth response: %s", response.text)
 
-    response_data = response.json()
-    if "access_token" not in response_data:
-        print("[ERROR] access token not found (BAD KEY/SECRET?)")
-        return False
+        response_data = response.json()
+        if "access_token" not in response_data:
+            print("[ERROR] access token not found (BAD KEY/SECRET?)")
+            return False
 
-    token = response_data["access_token"]
-    auth_timestamp = time.time()
+        token = response_data["access_token"]
+        auth_timestamp = time.time()
 
-    headers = {
-        'accept': 'application/json',
-        'Authorization': f'Bearer {token}'
-    }
-    print("[VERBOSE] Authentication successful")
+        headers = {
+            'accept': 'application/json',
+            'Authorization': f'Bearer {token}'
+        }
+        log.debug("Authentication successful")
+
+        return True
 
-    return True
+
+def clean_isbn(isbn):
+    """Strip hyphens, spaces and other noise from an ISBN. Returns None unless 10 or 13 characters remain."""
+    isbn = _ISBN_RE.sub('', isbn or '').upper()
+    return isbn if len(isbn) in (10, 13) else None
 
 
 def _get_creator_name(contributor_info):
@@ -64,13 +108,6 @@ def _get_creator_name(contributor_info):
     if not isinstance(creators, list):
         return None
 
-    # Roles that disqualify a person from being a "creator only"
-    non_creator_roles = {
-        'editor', 'compiler', 'voice actor', 'ed.lit', 'mitwirkender',
-        'buchgestalter', 'herausgeber', 'drucker', 'buchbinder', 'issuing body',
-        'hörfunkproduzent', 'verlag', 'regisseur', 'synchronsprecher', 'narrator'
-    }
-
     for creator in creators:
         if not isinstance(creator, dict) or creator.get('type') != 'person':
             continue
@@ -79,8 +116,8 @@ def _get_creator_name(contributor_info):
         relators = creator.get('relators')
         if isinstance(relators, list):
             for relator in relators:
-                term = (relator or {}).get('term', '').lower()
-                if term in non_creator_roles:
+                term = relator.get('term') if relator else None
+                if term and term.lower() in NON_CREATOR_ROLES:
                     is_creator_only = False
                     break
 
@@ -176,10 +213,35 @@ def _extract_bib_data(data):
     return simplified_records
 
 
+def load_cached_record(isbn):
+    """
+    Look up an ISBN in the WorldCat cache.
+    Returns (True, record_or_None) on a cache hit and (False, None) on a miss.
+    """
+    cache_path = os.path.join(WORLDCAT_CACHE_DIR, f'{isbn}.json')
+    if not os.path.exists(cache_path):
+        return False, None
+
+    with open(cache_path, 'rb') as f:
+        return True, orjson.loads(f.read())
+
+
+def save_cached_record(isbn, record):
+    """Cache a WorldCat answer for an ISBN. None is stored too, so known misses are not retried."""
+    cache_path = os.path.join(WORLDCAT_CACHE_DIR, f'{isbn}.json')
+    with open(cache_path, 'wb') as f:
+        f.write(orjson.dumps(record))
+
+
 def search_worldcat_by_isbn(isbn, oclc_client_id, oclc_secret):
     """Search WorldCat by ISBN."""
     global headers
 
+    cached, record = load_cached_record(isbn)
+    if cached:
+        log.debug("  Using cached WorldCat result for ISBN: %s", isbn)
+        return record
+
     # Check if we need to reauth
     reauth_okay = reauth(oclc_client_id, oclc_secret)
 
@@ -193,77 +255,91 @@ def search_worldcat_by_isbn(isbn, oclc_client_id, oclc_secret):
         'limit': 10
     }
 
-    print(f"  [VERBOSE] Searching WorldCat with URL: {url}")
-    print(f"  [VERBOSE] Query params: {params}")
+    log.debug("  Searching WorldCat with URL: %s", url)
+    log.debug("  Query params: %s", params)
 
     try:
-        response = requests.get(url, headers=headers, params=params)
-        print(f"  [VERBOSE] Response status: {response.status_code}")
+        rate_limiter.wait()
+        response = SESSION.get(url, headers=headers, params=params)
+        rate_limiter.observe(response)
+        log.debug("  Response status: %s", response.status_code)
 
         data = response.json()
-        print(f"  [VERBOSE] Number of records found: {data.get('numberOfRecords', 0)}")
+        log.debug("  Number of records found: %s", data.get('numberOfRecords', 0))
 
         if data.get('numberOfRecords', 0) == 0:
-            return None
+            record = None
+        else:
+            # Extract the bibliographic data
+            extracted_data = _extract_bib_data(data)
+            record = extracted_data[0] if extracted_data else None
 
-        # Extract and return the bibliographic data
-        extracted_data = _extract_bib_data(data)
-        return extracted_data[0] if extracted_data else None
+        # Only cache real answers, not auth or server errors
+        if response.ok:
+            save_cached_record(isbn, record)
+
+        return record
 
     except Exception as e:
         print(f"  [ERROR] Error querying WorldCat: {e}")
         return None
 
 
-def load_books():
-    """Load books from JSON file."""
-    with open('data/books_by_title.json', 'r') as f:
-        return json.load(f)
+def search_worldcat_by_isbns(isbns, executor, oclc_client_id, oclc_secret):
+    """
+    Search WorldCat for all ISBNs of a book concurrently.
+    Returns (isbn, record) for the first ISBN in list order that matches, or (None, None).
+    """
+    futures = [
+        executor.submit(search_worldcat_by_isbn, isbn, oclc_client_id, oclc_secret)
+        for isbn in isbns
+    ]
+
+    try:
+        for isbn, future in zip(isbns, futures):
+            worldcat_record = future.result()
+            if worldcat_record:
+                return isbn, worldcat_record
+            log.debug("  No match for ISBN: %s", isbn)
+    finally:
+        # Drop lookups that have not started once we have an answer
+        for future in futures:
+            future.cancel()
+
+    return None, None
 
 
-def save_books(books):
-    """Save books to JSON file."""
-    with open('data/books_by_title.json', 'w') as f:
-        json.dump(books, f, indent=2)
+def merge_unique(existing, new_items):
+    """Append new_items to existing, dropping duplicates but keeping first-seen order."""
+    return list(dict.fromkeys([*existing, *new_items]))
 
 
-def update_book_with_worldcat_data(book_data, worldcat_record):
-    """Update book metadata with WorldCat data."""
-    print(f"  [VERBOSE] Updating book metadata from WorldCat...")
+def update_book_with_worldcat_data(book_data, worldcat_record, isbn):
+    """Update book metadata with WorldCat data found by searching for isbn."""
+    log.debug("  Updating book metadata from WorldCat...")
 
     metadata = book_data['metadata']
 
-    # Update OCLC number
+    # Update OCLC number, followed by merged OCLC numbers if available
     if worldcat_record.get('oclcNumber'):
-        if 'oclc_numbers' not in metadata:
-            metadata['oclc_numbers'] = []
-
         oclc_num = worldcat_record['oclcNumber']
-        if oclc_num not in metadata['oclc_numbers']:
-            metadata['oclc_numbers'].append(oclc_num)
-            print(f"  [VERBOSE] Added OCLC number: {oclc_num}")
-
-        # Add merged OCLC numbers if available
-        if worldcat_record.get('mergedOclcNumbers'):
-            for merged_num in worldcat_record['mergedOclcNumbers']:
-                if merged_num not in metadata['oclc_numbers']:
-                    metadata['oclc_numbers'].append(merged_num)
-            print(f"  [VERBOSE] Added {len(worldcat_record['mergedOclcNumbers'])} merged OCLC numbers")
+        merged_nums = worldcat_record.get('mergedOclcNumbers') or []
+        metadata['oclc_numbers'] = merge_unique(metadata.get('oclc_numbers') or [], [oclc_num, *merged_nums])
+        log.debug("  Added OCLC number: %s", oclc_num)
+        if merged_nums:
+            log.debug("  Added %s merged OCLC numbers", len(merged_nums))
 
     # Update subjects
     if worldcat_record.get('subjects'):
         # Ensure subjects is a list
-        if 'subjects' not in metadata:
-            metadata['subjects'] = []
-        elif not isinstance(metadata['subjects'], list):
+        subjects = metadata.get('subjects') or []
+        if not isinstance(subjects, list):
             # Convert to list if it's a string or other type
-            metadata['subjects'] = [metadata['subjects']] if metadata['subjects'] else []
+            subjects = [subjects]
 
-        for subject in worldcat_record['subjects']:
-            if subject not in metadata['subjects']:
-                metadata['subjects'].append(subject)
+        metadata['subjects'] = merge_unique(subjects, worldcat_record['subjects'])
 
-        print(f"  [VERBOSE] Added/updated subjects ({len(worldcat_record['subjects'])} total)")
+        log.debug("  Added/updated subjects (%s total)", len(worldcat_record['subjects']))
 
     # Update LCCN if missing
     if worldcat_record.get('lccn') and not metadata.get('lccn'):
@@ -272,37 +348,46 @@ def update_book_with_worldcat_data(book_data, worldcat_record):
         if isinstance(metadata['lccn'], list):
             if worldcat_record['lccn'] not in metadata['lccn']:
                 metadata['lccn'].append(worldcat_record['lccn'])
-        print(f"  [VERBOSE] Added LCCN: {worldcat_record['lccn']}")
+        log.debug("  Added LCCN: %s", worldcat_record['lccn'])
 
     # Update classifications
     if worldcat_record.get('classifications'):
         metadata['classifications'] = worldcat_record['classifications']
-        print(f"  [VERBOSE] Added classifications")
+        log.debug("  Added classifications")
 
     # Update publication date if missing
     if worldcat_record.get('publicationDate') and not metadata.get('publishedDate'):
         metadata['publishedDate'] = worldcat_record['publicationDate']
-        print(f"  [VERBOSE] Added publication date: {worldcat_record['publicationDate']}")
+        log.debug("  Added publication date: %s", worldcat_record['publicationDate'])
 
     # Update language if missing
     if worldcat_record.get('itemLanguage') and not metadata.get('language'):
         metadata['language'] = worldcat_record['itemLanguage']
-        print(f"  [VERBOSE] Added language: {worldcat_record['itemLanguage']}")
+        log.debug("  Added language: %s", worldcat_record['itemLanguage'])
 
     # Update format if missing
     if worldcat_record.get('generalFormat') and not metadata.get('generalFormat'):
         metadata['generalFormat'] = worldcat_record['generalFormat']
-        print(f"  [VERBOSE] Added format: {worldcat_record['generalFormat']}")
+        log.debug("  Added format: %s", worldcat_record['generalFormat'])
 
-    # Store the complete WorldCat record for reference
-    metadata['worldcat_record'] = worldcat_record
-    print(f"  [VERBOSE] Stored complete WorldCat record")
+    # Keep only a reference; the full record is in the WorldCat cache under the
+    # cleaned ISBN that matched, so store that ISBN to find it again
+    metadata['worldcat_oclc_ref'] = worldcat_record.get('oclcNumber')
+    metadata['worldcat_isbn'] = isbn
+    log.debug("  Stored WorldCat record reference")
 
     return book_data
 
 
 def main():
     """Main execution function."""
+    # Per-request detail is logged at DEBUG; run with LOGLEVEL=DEBUG to see it
+    logging.basicConfig(
+        level=os.environ.get('LOGLEVEL', 'INFO').upper(),
+        format='%(message)s',
+        stream=sys.stdout,
+    )
+
     # Get OCLC credentials from environment
     oclc_client_id = os.environ.get('OCLC_CLIENT_ID')
     oclc_secret = os.environ.get('OCLC_SECRET')
@@ -311,24 +396,32 @@ def main():
         print("[ERROR] OCLC_CLIENT_ID and OCLC_SECRET environment variables must be set")
         return
 
-    print("[VERBOSE] Starting OCLC and Subjects addition script...")
-    print("[VERBOSE] Loading books from data/books_by_title.json...")
+    log.info("Starting OCLC and Subjects addition script...")
+    log.info("Loading books from %s...", BOOKS_FILE)
 
     books = load_books()
     total_books = len(books)
-    print(f"[VERBOSE] Loaded {total_books} books total")
+    log.info("Loaded %s books total", total_books)
 
-    # Count books needing OCLC numbers
-    books_needing_oclc = 0
-    for book_data in books.values():
-        metadata = book_data.get('metadata', {})
-        oclc_numbers = metadata.get('oclc_numbers', [])
-        isbns = metadata.get('isbns', [])
+    # Recover updates from a previous run that did not finish
+    recovered = apply_updates(books, UPDATES_FILE)
+    if recovered:
+        log.info("Recovered %s updates from %s", recovered, UPDATES_FILE)
 
-        if (not oclc_numbers or len(oclc_numbers) == 0) and (isbns and len(isbns) > 0):
-            books_needing_oclc += 1
+    # Build the work queue in one pass: books with valid ISBNs but no OCLC numbers
+    work = []
+    for book_id, book_data in books.items():
+        metadata = book_data.get('metadata') or {}
+        if metadata.get('oclc_numbers'):
+            continue
+
+        # Normalize and dedupe ISBNs up front so malformed ones never reach WorldCat
+        isbns = list(dict.fromkeys(filter(None, map(clean_isbn, metadata.get('isbns') or ()))))
+        if isbns:
+            work.append((book_id, book_data, isbns))
 
-    print(f"[VERBOSE] Found {books_needing_oclc} books with ISBNs but no OCLC numbers")
+    books_needing_oclc = len(work)
+    log.info("Found %s books with ISBNs but no OCLC numbers", books_needing_oclc)
     print("\n" + "="*80 + "\n")
 
     processed_count = 0
@@ -336,61 +429,45 @@ def main():
     skipped_count = 0
     failed_count = 0
 
-    for book_id, book_data in books.items():
-        metadata = book_data.get('metadata', {})
-        oclc_numbers = metadata.get('oclc_numbers', [])
-        isbns = metadata.get('isbns', [])
-
-        # Skip if already has OCLC number or no ISBNs
-        if (oclc_numbers and len(oclc_numbers) > 0) or (not isbns or len(isbns) == 0):
-            continue
-
-        title = metadata.get('title', 'N/A')
-        author = metadata.get('author', 'N/A')
+    os.makedirs(WORLDCAT_CACHE_DIR, exist_ok=True)
 
-        processed_count += 1
-        print(f"\n[{processed_count}/{books_needing_oclc}] Processing Book ID: {book_id}")
-        print(f"  Title: {title}")
-        print(f"  Author: {author}")
-        print(f"  ISBNs available: {len(isbns)}")
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    updates_fp = open(UPDATES_FILE, 'ab')
+    try:
+        for processed_count, (book_id, book_data, isbns) in enumerate(work, 1):
+            metadata = book_data['metadata']
+            title = metadata.get('title', 'N/A')
+            author = metadata.get('author', 'N/A')
 
-        # Try each ISBN until we get a hit
-        worldcat_record = None
-        for idx, isbn in enumerate(isbns):
-            print(f"  [VERBOSE] Trying ISBN {idx + 1}/{len(isbns)}: {isbn}")
+            print(f"\n[{processed_count}/{books_needing_oclc}] Processing Book ID: {book_id}")
+            print(f"  Title: {title}")
+            print(f"  Author: {author}")
+            print(f"  ISBNs available: {len(isbns)}")
 
-            worldcat_record = search_worldcat_by_isbn(isbn, oclc_client_id, oclc_secret)
+            # Query all ISBNs at once and keep the first hit in ISBN order
+            isbn, worldcat_record = search_worldcat_by_isbns(isbns, executor, oclc_client_id, oclc_secret)
 
             if worldcat_record:
                 print(f"  [SUCCESS] Found match with ISBN: {isbn}")
                 print(f"    - WorldCat Title: {worldcat_record.get('mainTitle', 'N/A')}")
                 print(f"    - WorldCat Author: {worldcat_record.get('creator', 'N/A')}")
                 print(f"    - OCLC Number: {worldcat_record.get('oclcNumber', 'N/A')}")
-                break
-            else:
-                print(f"  [VERBOSE] No match for ISBN: {isbn}")
-
-            # Small delay between ISBN searches
-            time.sleep(0.5)
 
-        if worldcat_record:
-            # Update the book with WorldCat data
-            book_data = update_book_with_worldcat_data(book_data, worldcat_record)
-            books[book_id] = book_data
-            updated_count += 1
+                # Update the book with WorldCat data
+                book_data = update_book_with_worldcat_data(book_data, worldcat_record, isbn)
+                books[book_id] = book_data
+                updated_count += 1
 
-            # Save after each successful update
-            print(f"  [VERBOSE] Saving to disk...")
-            save_books(books)
-            print(f"  [VERBOSE] Save complete")
-        else:
-            print(f"  [RESULT] No WorldCat match found for any ISBN")
-            failed_count += 1
+                # Record the update in the sidecar; the full file is written once at the end
+                append_update(updates_fp, book_id, book_data)
+            else:
+                print(f"  [RESULT] No WorldCat match found for any ISBN")
+                failed_count += 1
 
-        # Rate limiting
-        print(f"  [VERBOSE] Waiting 1 second before next request...")
-        time.sleep(1)
-        print("\n" + "-"*80)
+            print("\n" + "-"*80)
+    finally:
+        executor.shutdown(cancel_futures=True)
+        close_journal(books, updates_fp, UPDATES_FILE)
 
     print("\n" + "="*80)
     print("[COMPLETE] OCLC and Subjects addition complete!")
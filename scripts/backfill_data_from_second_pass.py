@@ -4,21 +4,34 @@ Backfill missing metadata from refined_data_pass_two_enriched.csv into books_by_
 Matches on title (removing parenthetical) and author.
 """
 
-import json
 import csv
+import functools
 import re
+import sys
+import orjson
 from pathlib import Path
 
 
+# Trailing parenthetical at the end of a title
+_PAREN_RE = re.compile(r'\s*\([^)]*\)\s*$')
+
+
+@functools.lru_cache(maxsize=None)
 def normalize_title(title):
     """Remove parenthetical from title for matching."""
     # Remove everything in parentheses at the end of the title
-    return re.sub(r'\s*\([^)]*\)\s*$', '', title).strip()
+    return sys.intern(_PAREN_RE.sub('', title).strip())
+
 
+def match_key(title_norm, author_norm):
+    """Build a single string lookup key from normalized title and author."""
+    return f"{title_norm.lower()}\x00{author_norm.lower()}"
 
+
+@functools.lru_cache(maxsize=None)
 def normalize_author(author):
     """Normalize author name for matching."""
-    return author.strip() if author else ""
+    return sys.intern(author.strip()) if author else ""
 
 
 def parse_isbns(isbn_string):
@@ -37,8 +50,8 @@ def main():
 
     # Load JSON data
     print(f"Loading {json_path}...")
-    with open(json_path, 'r', encoding='utf-8') as f:
-        books_data = json.load(f)
+    with open(json_path, 'rb') as f:
+        books_data = orjson.loads(f.read())
 
     # Find books with empty ISBNs
     books_needing_data = []
@@ -59,27 +72,45 @@ def main():
     print(f"Loading {csv_path}...")
     csv_lookup = {}
     with open(csv_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
+        reader = csv.reader(f)
+        header = next(reader)
+
+        # Resolve column positions once instead of building a dict per row
+        title_i, author_i, isbn_i, description_i, language_i, page_count_i, subjects_i, genres_i = (
+            header.index(name) for name in
+            ('Title', 'Author', 'ISBN', 'Description', 'Language', 'Page Count', 'Subjects', 'Genres')
+        )
+        column_count = len(header)
+
         for row in reader:
-            title = row.get('Title', '')
-            author = row.get('Author', '')
-
-            if title and author:
-                title_norm = normalize_title(title)
-                author_norm = normalize_author(author)
-                key = (title_norm.lower(), author_norm.lower())
-
-                # Store the row data
-                csv_lookup[key] = {
-                    'isbns': parse_isbns(row.get('ISBN', '')),
-                    'title': title,
-                    'author': author,
-                    'description': row.get('Description', ''),
-                    'language': row.get('Language', ''),
-                    'page_count': row.get('Page Count', ''),
-                    'subjects': row.get('Subjects', ''),
-                    'genres': row.get('Genres', ''),
-                }
+            # Pad blank and short rows to the header, as DictReader would
+            if len(row) < column_count:
+                row += [''] * (column_count - len(row))
+
+            title = row[title_i]
+            author = row[author_i]
+
+            if not title or not author:
+                continue
+
+            # Rows without ISBNs can never be used to backfill
+            isbns = parse_isbns(row[isbn_i])
+            if not isbns:
+                continue
+
+            key = match_key(normalize_title(title), normalize_author(author))
+
+            # Store the row data
+            csv_lookup[key] = {
+                'isbns': isbns,
+                'title': title,
+                'author': author,
+                'description': row[description_i],
+                'language': row[language_i],
+                'page_count': row[page_count_i],
+                'subjects': row[subjects_i],
+                'genres': row[genres_i],
+            }
 
     print(f"Loaded {len(csv_lookup)} entries from CSV")
 
@@ -88,37 +119,35 @@ def main():
     updated_books = 0
 
     for book in books_needing_data:
-        key = (book['title_normalized'].lower(), book['author_normalized'].lower())
+        key = match_key(book['title_normalized'], book['author_normalized'])
 
         if key in csv_lookup:
             matches_found += 1
             csv_data = csv_lookup[key]
 
-            # Only update if CSV has ISBNs
-            if csv_data['isbns']:
-                book_id = book['id']
-                books_data[book_id]['metadata']['isbns'] = csv_data['isbns']
+            book_id = book['id']
+            books_data[book_id]['metadata']['isbns'] = csv_data['isbns']
 
-                # Optionally update other metadata if empty
-                metadata = books_data[book_id]['metadata']
+            # Optionally update other metadata if empty
+            metadata = books_data[book_id]['metadata']
 
-                if csv_data.get('description') and not metadata.get('description'):
-                    metadata['description'] = csv_data['description']
+            if csv_data.get('description') and not metadata.get('description'):
+                metadata['description'] = csv_data['description']
 
-                if csv_data.get('language') and not metadata.get('language'):
-                    metadata['language'] = csv_data['language']
+            if csv_data.get('language') and not metadata.get('language'):
+                metadata['language'] = csv_data['language']
 
-                if csv_data.get('page_count') and not metadata.get('page_count'):
-                    metadata['page_count'] = csv_data['page_count']
+            if csv_data.get('page_count') and not metadata.get('page_count'):
+                metadata['page_count'] = csv_data['page_count']
 
-                if csv_data.get('subjects') and not metadata.get('subjects'):
-                    metadata['subjects'] = csv_data['subjects']
+            if csv_data.get('subjects') and not metadata.get('subjects'):
+                metadata['subjects'] = csv_data['subjects']
 
-                if csv_data.get('genres') and not metadata.get('genres'):
-                    metadata['genres'] = csv_data['genres']
+            if csv_data.get('genres') and not metadata.get('genres'):
+                metadata['genres'] = csv_data['genres']
 
-                updated_books += 1
-                print(f"✓ Updated: {book['title']} by {book['author']} - {len(csv_data['isbns'])} ISBNs")
+            updated_books += 1
+            print(f"✓ Updated: {book['title']} by {book['author']} - {len(csv_data['isbns'])} ISBNs")
 
     print(f"\nMatches found: {matches_found}")
     print(f"Books updated: {updated_books}")
@@ -126,8 +155,8 @@ def main():
     # Write updated JSON back
     if updated_books > 0:
         print(f"\nWriting updated data to {json_path}...")
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(books_data, f, indent=2, ensure_ascii=False)
+        with open(json_path, 'wb') as f:
+            f.write(orjson.dumps(books_data))
         print("✓ Done!")
     else:
         print("\nNo updates made.")
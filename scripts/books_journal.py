@@ -0,0 +1,71 @@
+"""
+Load and save books_by_title.json, journaling updates to a JSONL sidecar in
+between so a crashed run loses nothing. Each script journals to its own
+sidecar, so one script never replays another's leftover updates.
+"""
+
+import logging
+import orjson
+import os
+
+
+log = logging.getLogger(__name__)
+
+BOOKS_FILE = 'data/books_by_title.json'
+
+
+def load_books():
+    """Load books from JSON file."""
+    with open(BOOKS_FILE, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+def save_books(books):
+    """Save books to JSON file."""
+    with open(BOOKS_FILE, 'wb') as f:
+        f.write(orjson.dumps(books, option=orjson.OPT_INDENT_2))
+
+
+def append_update(updates_fp, book_id, book_data):
+    """Append one updated book to the JSONL sidecar and flush it to disk."""
+    updates_fp.write(orjson.dumps({'id': book_id, 'data': book_data}) + b'\n')
+    updates_fp.flush()
+    os.fsync(updates_fp.fileno())
+
+
+def apply_updates(books, updates_file):
+    """Replay updates left in a JSONL sidecar onto books. Returns the number applied."""
+    if not os.path.exists(updates_file):
+        return 0
+
+    applied = 0
+    with open(updates_file, 'rb') as f:
+        for line in f:
+            try:
+                update = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # A crash mid-write can leave a truncated last line
+                continue
+            books[update['id']] = update['data']
+            applied += 1
+
+    return applied
+
+
+def checkpoint(books, updates_fp):
+    """Write the full books file and empty the sidecar, whose updates it now holds."""
+    log.info("  Saving to disk...")
+    save_books(books)
+    updates_fp.seek(0)
+    updates_fp.truncate()
+    log.info("  Save complete")
+
+
+def close_journal(books, updates_fp, updates_file):
+    """Close the sidecar, write the full file once with everything in it, and remove it."""
+    updates_fp.close()
+    if apply_updates(books, updates_file):
+        log.info("Saving to disk...")
+        save_books(books)
+        log.info("Save complete")
+    os.remove(updates_file)
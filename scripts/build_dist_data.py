@@ -4,14 +4,18 @@ Build Distribution Data Script
 Takes the full books_by_title.json and creates a minimal array for the interface.
 """
 
-import json
+import bisect
 import os
+import orjson
+
+
+POPULARITY_LABELS = ('Less Popular', 'Medium', 'Popular', 'Very Popular')
 
 
 def load_books():
     """Load books from JSON file."""
-    with open('data/books_by_title.json', 'r') as f:
-        return json.load(f)
+    with open('data/books_by_title.json', 'rb') as f:
+        return orjson.loads(f.read())
 
 
 def clean_subjects(subjects):
@@ -20,42 +24,50 @@ def clean_subjects(subjects):
         return subjects
 
     if isinstance(subjects, list):
-        return [s.replace('--Fiction', '') for s in subjects]
+        # Scan the whole list in one C-level pass and leave it untouched when there is nothing to strip
+        joined = '\x00'.join(subjects)
+        if '--Fiction' not in joined:
+            return subjects
+        return joined.replace('--Fiction', '').split('\x00')
     elif isinstance(subjects, str):
         return subjects.replace('--Fiction', '')
 
     return subjects
 
 
-def calculate_popularity_stats(books):
-    """Calculate statistics for holdings and editions to determine popularity tiers."""
-    holdings_counts = []
-    editions_counts = []
+def extract_holdings(metadata):
+    """Return (totalHoldingCount, totalEditions) from a book's holdings data."""
+    holdings_data = metadata.get('holdings', {})
 
-    for book_id, book_data in books.items():
-        metadata = book_data.get('metadata', {})
-        holdings_data = metadata.get('holdings', {})
+    if holdings_data and 'totalHoldingCount' in holdings_data:
+        return holdings_data.get('totalHoldingCount'), holdings_data.get('totalEditions')
+
+    # Books fetched before holdings were stored flat still have the full API response
+    if holdings_data and 'briefRecords' in holdings_data:
+        brief_records = holdings_data.get('briefRecords', [])
+        if brief_records:
+            institution_holding = brief_records[0].get('institutionHolding', {})
+            return institution_holding.get('totalHoldingCount'), institution_holding.get('totalEditions')
 
-        if holdings_data and 'briefRecords' in holdings_data:
-            brief_records = holdings_data.get('briefRecords', [])
-            if brief_records:
-                first_record = brief_records[0]
-                institution_holding = first_record.get('institutionHolding', {})
+    return None, None
 
-                total_holding_count = institution_holding.get('totalHoldingCount')
-                total_editions = institution_holding.get('totalEditions')
 
-                if total_holding_count is not None:
-                    holdings_counts.append(total_holding_count)
-                if total_editions is not None:
-                    editions_counts.append(total_editions)
+def iter_books(books):
+    """Yield (book_id, book_data, metadata, totalHoldingCount, totalEditions) for every book."""
+    for book_id, book_data in books.items():
+        metadata = book_data.get('metadata') or {}
+        total_holding_count, total_editions = extract_holdings(metadata)
+        yield book_id, book_data, metadata, total_holding_count, total_editions
+
+
+def calculate_popularity_stats(book_rows):
+    """Calculate statistics for holdings and editions to determine popularity tiers."""
+    holdings_counts = sorted(row[3] for row in book_rows if row[3] is not None)
+    editions_counts = sorted(row[4] for row in book_rows if row[4] is not None)
 
     if not holdings_counts:
         return None
 
-    holdings_counts.sort()
-    editions_counts.sort()
-
     # Calculate quartiles for holdings
     holdings_avg = sum(holdings_counts) / len(holdings_counts)
     holdings_q1 = holdings_counts[len(holdings_counts) // 4]
@@ -76,9 +88,18 @@ def calculate_popularity_stats(books):
     }
 
 
-def determine_popularity(total_holding_count, total_editions, stats):
+def popularity_thresholds(stats):
+    """Composite score thresholds for Medium, Popular and Very Popular, in ascending order."""
+    return (
+        stats['holdings_q1'] + (stats['editions_q2'] * 25),
+        stats['holdings_q2'] + (stats['editions_q2'] * 50),
+        stats['holdings_q3'] + (stats['editions_q2'] * 50),
+    )
+
+
+def determine_popularity(total_holding_count, total_editions, thresholds):
     """Determine popularity level based on holdings and editions."""
-    if not stats or total_holding_count is None:
+    if not thresholds or total_holding_count is None:
         return None
 
     # Create a composite score based on holdings (weighted more) and editions
@@ -87,81 +108,42 @@ def determine_popularity(total_holding_count, total_editions, stats):
 
     composite_score = holdings_score + editions_score
 
-    # Calculate thresholds based on quartiles
-    threshold_very_popular = stats['holdings_q3'] + (stats['editions_q2'] * 50)
-    threshold_popular = stats['holdings_q2'] + (stats['editions_q2'] * 50)
-    threshold_medium = stats['holdings_q1'] + (stats['editions_q2'] * 25)
-
-    if composite_score >= threshold_very_popular:
-        return 'Very Popular'
-    elif composite_score >= threshold_popular:
-        return 'Popular'
-    elif composite_score >= threshold_medium:
-        return 'Medium'
-    else:
-        return 'Less Popular'
+    # Number of thresholds reached picks the tier
+    return POPULARITY_LABELS[bisect.bisect_right(thresholds, composite_score)]
+
+
+def first_value(metadata, key):
+    """Return the first item of a list field, or None if it is missing or empty."""
+    values = metadata.get(key)
+    return values[0] if values else None
+
 
+def minify_book(book_id, book_data, metadata, total_holding_count, total_editions, thresholds):
+    """Build the minimal record for a single book."""
+    mget = metadata.get
 
-def build_minimal_data(books, stats):
+    return {
+        'id': book_id,
+        'title': mget('title'),
+        'author': mget('author'),
+        'isbn': first_value(metadata, 'isbns'),
+        'oclc': first_value(metadata, 'oclc_numbers'),
+        'lccn': first_value(metadata, 'lccn'),
+        'description': mget('description'),
+        'pageCount': first_value(metadata, 'page_counts'),
+        'subjects': clean_subjects(mget('subjects_clean')),
+        'bans': book_data.get('bans', []),
+        'totalHoldingCount': total_holding_count,
+        'totalEditions': total_editions,
+        'popularityLevel': determine_popularity(total_holding_count, total_editions, thresholds)
+    }
+
+
+def build_minimal_data(book_rows, stats):
     """Build minimal data array for the interface."""
-    minimal_books = []
+    thresholds = popularity_thresholds(stats) if stats else None
 
-    for book_id, book_data in books.items():
-        metadata = book_data.get('metadata', {})
-        bans = book_data.get('bans', [])
-
-        # Extract first values from arrays or None
-        isbns = metadata.get('isbns', [])
-        first_isbn = isbns[0] if isbns else None
-
-        oclc_numbers = metadata.get('oclc_numbers', [])
-        first_oclc = oclc_numbers[0] if oclc_numbers else None
-
-        lccn = metadata.get('lccn', [])
-        first_lccn = lccn[0] if lccn else None
-
-        page_counts = metadata.get('page_counts', [])
-        first_page_count = page_counts[0] if page_counts else None
-
-        # Clean subjects
-        subjects = clean_subjects(metadata.get('subjects_clean'))
-
-        # Extract holdings data
-        holdings_data = metadata.get('holdings', {})
-        total_holding_count = None
-        total_editions = None
-
-        if holdings_data and 'briefRecords' in holdings_data:
-            brief_records = holdings_data.get('briefRecords', [])
-            if brief_records:
-                first_record = brief_records[0]
-                institution_holding = first_record.get('institutionHolding', {})
-                total_holding_count = institution_holding.get('totalHoldingCount')
-                total_editions = institution_holding.get('totalEditions')
-
-        # Determine popularity level
-        popularity_level = determine_popularity(total_holding_count, total_editions, stats)
-
-        # Build minimal record
-        minimal_record = {
-            'id': book_id,
-            'title': metadata.get('title'),
-            'author': metadata.get('author'),
-            'isbn': first_isbn,
-            'oclc': first_oclc,
-            'lccn': first_lccn,
-            'description': metadata.get('description'),
-            'pageCount': first_page_count,
-            'subjects': subjects,
-            'bans': bans,
-            'totalHoldingCount': total_holding_count,
-            'totalEditions': total_editions,
-            'popularityLevel': popularity_level
-        }
-
-        minimal_books.append(minimal_record)
-
-    return minimal_books
+    return [minify_book(*row, thresholds) for row in book_rows]
 
 
 def save_dist_data(minimal_books):
@@ -169,8 +151,8 @@ def save_dist_data(minimal_books):
     # Ensure the directory exists
     os.makedirs('apps/public', exist_ok=True)
 
-    with open('apps/public/data.json', 'w') as f:
-        json.dump(minimal_books, f, indent=2)
+    with open('apps/public/data.json', 'wb') as f:
+        f.write(orjson.dumps(minimal_books, option=orjson.OPT_INDENT_2))
 
 
 def main():
@@ -185,7 +167,9 @@ def main():
     print(f"[VERBOSE] Loaded {len(books)} books")
 
     print("[VERBOSE] Calculating popularity statistics...")
-    stats = calculate_popularity_stats(books)
+    # Walk the books once; stats and minimal records both read from these rows
+    book_rows = tuple(iter_books(books))
+    stats = calculate_popularity_stats(book_rows)
     if stats:
         print(f"[VERBOSE] Holdings average: {stats['holdings_avg']:.2f}")
         print(f"[VERBOSE] Holdings Q1/Q2/Q3: {stats['holdings_q1']}/{stats['holdings_q2']}/{stats['holdings_q3']}")
@@ -194,7 +178,7 @@ def main():
         print("[VERBOSE] No holdings data found, popularity levels will be None")
 
     print("[VERBOSE] Building minimal data array...")
-    minimal_books = build_minimal_data(books, stats)
+    minimal_books = build_minimal_data(book_rows, stats)
     print(f"[VERBOSE] Created {len(minimal_books)} minimal book records")
 
     # Count popularity levels
@@ -4,30 +4,218 @@ Clean subject headings in books_by_title.json using Google Gemini API.
 Removes non-English, format-based subjects, and consolidates duplicates.
 """
 
-import json
+import asyncio
+import hashlib
+import orjson
 import os
+import time
+from collections import deque
 from pathlib import Path
 from google import genai
-from google.genai import types
+from google.genai import errors, types
+from pydantic import BaseModel
 
+from gemini_utils import MAX_RETRIES, RETRYABLE_STATUS_CODES, retry_delay_from_error
 
-def clean_subjects_with_gemini(subjects_list, client, model="gemini-flash-latest"):
+
+# Maximum number of Gemini requests in flight at once
+MAX_CONCURRENT_REQUESTS = 8
+
+# Number of books whose subjects are cleaned in one Gemini request
+BATCH_SIZE = 20
+
+# Gemini quota for the model (requests and tokens per minute)
+REQUESTS_PER_MINUTE = 60
+TOKENS_PER_MINUTE = 250000
+
+# Cleaned subjects from earlier calls, keyed by a hash of the normalized subject list
+GEMINI_CACHE_DIR = Path('data') / '.gemini_cache'
+
+# Per-request timeout for Gemini calls, in milliseconds
+REQUEST_TIMEOUT_MS = 20000
+
+# Floor for the response token cap; larger prompts get about twice their size
+MIN_OUTPUT_TOKENS = 1024
+
+
+class RateLimiter:
+    """Sliding one-minute window limiter on request count and token usage."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute, window=60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        self.request_times = deque()
+        self.token_usage = deque()  # (timestamp, tokens)
+        self.tokens_in_window = 0
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _expire(self, now):
+        """Drop requests that have left the window."""
+        while self.request_times and self.request_times[0] <= now - self.window:
+            self.request_times.popleft()
+        while self.token_usage and self.token_usage[0][0] <= now - self.window:
+            self.tokens_in_window -= self.token_usage.popleft()[1]
+
+    async def acquire(self, tokens):
+        """Wait until a request using the given number of tokens fits in the window."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self._expire(now)
+
+                wait = self.blocked_until - now
+                if len(self.request_times) >= self.requests_per_minute:
+                    wait = max(wait, self.request_times[0] + self.window - now)
+                if self.token_usage and self.tokens_in_window + tokens > self.tokens_per_minute:
+                    wait = max(wait, self.token_usage[0][0] + self.window - now)
+
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            self.request_times.append(now)
+            self.token_usage.append((now, tokens))
+            self.tokens_in_window += tokens
+
+    def block_for(self, seconds):
+        """Hold back all requests for a while, e.g. after the API returns 429."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class Checkpoint:
+    """Append-only JSONL log of cleaned subjects, one {"id", "subjects_clean"} object per line."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = asyncio.Lock()
+        self.fp = None
+
+    def load(self):
+        """Return {book_id: subjects_clean} for everything logged so far."""
+        completed = {}
+        if not self.path.exists():
+            return completed
+
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # A crash mid-write can leave a truncated last line
+                    continue
+                completed[entry['id']] = entry['subjects_clean']
+
+        return completed
+
+    def open(self):
+        self.fp = open(self.path, 'ab')
+
+    def close(self):
+        self.fp.close()
+
+    async def append(self, book_id, subjects_clean):
+        """Durably record one book's cleaned subjects."""
+        async with self.lock:
+            self.fp.write(orjson.dumps({'id': book_id, 'subjects_clean': subjects_clean}) + b"\n")
+            self.fp.flush()
+
+
+def subjects_cache_key(subjects):
+    """Hash a subject list after trimming, lowercasing, deduping and sorting it."""
+    normalized = sorted({s.strip().lower() for s in subjects})
+    return hashlib.blake2b(orjson.dumps(normalized), digest_size=16).hexdigest()
+
+
+def load_cached_subjects(subjects):
+    """Return the cached cleaned subjects for a subject list, or None on a cache miss."""
+    cache_path = GEMINI_CACHE_DIR / f'{subjects_cache_key(subjects)}.json'
+    if not cache_path.exists():
+        return None
+
+    with open(cache_path, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+def save_cached_subjects(subjects, cleaned_subjects):
+    """Cache Gemini's cleaned subjects for a subject list."""
+    cache_path = GEMINI_CACHE_DIR / f'{subjects_cache_key(subjects)}.json'
+    with open(cache_path, 'wb') as f:
+        f.write(orjson.dumps(cleaned_subjects))
+
+
+def apply_cleaned_subjects(books, completed):
+    """Copy cleaned subjects from the checkpoint into the books' metadata."""
+    for book_id, subjects_clean in completed.items():
+        if book_id in books:
+            books[book_id].setdefault('metadata', {})['subjects_clean'] = subjects_clean
+
+
+SYSTEM_INSTRUCTION = """You are given a list of book subject headings, the task to to remove any heading that is non-english and or not content based, for example AUDIOBOOK or LARGE PRINT are not valid content based subject headings.
+Remove any audience modifiers from the headings like JUVENILE FICTION or YOUNG ADULT FICTION and when them remove consolidate the headings if any of them are the same without those modifiers"""
+
+BATCH_SYSTEM_INSTRUCTION = SYSTEM_INSTRUCTION + """
+
+The input is a JSON object {"items": [{"id": ..., "subjects": [...]}, ...]}, clean each item's subjects independently.
+Return {"results": [{"id": ..., "subjects": [...]}, ...]} with one result per input item, using the same ids, with only the good headings."""
+
+
+def max_output_tokens_for(prompt_json):
+    """Cap the response at roughly twice the prompt's tokens (about 4 characters per token)."""
+    return max(MIN_OUTPUT_TOKENS, len(prompt_json) // 2)
+
+
+class CleanedSubjects(BaseModel):
+    id: int
+    subjects: list[str]
+
+
+class CleanedBatch(BaseModel):
+    results: list[CleanedSubjects]
+
+
+async def generate_with_retries(client, limiter, model, contents, config, estimated_tokens):
+    """Call Gemini, retrying rate limited and transient errors, and return the response."""
+    for attempt in range(MAX_RETRIES + 1):
+        await limiter.acquire(estimated_tokens)
+
+        try:
+            return await client.aio.models.generate_content(
+                model=model,
+                contents=contents,
+                config=config,
+            )
+        except errors.APIError as e:
+            if e.code not in RETRYABLE_STATUS_CODES or attempt == MAX_RETRIES:
+                raise
+
+            delay = retry_delay_from_error(e) or 2 ** attempt
+            if e.code == 429:
+                # Quota exhausted: pause every request, not just this one
+                limiter.block_for(delay)
+            print(f"    Gemini returned {e.code}, retrying in {delay:.0f}s...")
+            await asyncio.sleep(delay)
+
+
+async def clean_subjects_with_gemini(subjects_list, client, limiter, model="gemini-flash-latest"):
     """
     Send subjects list to Gemini API for cleaning.
 
     Args:
         subjects_list: List of subject headings
         client: Google GenAI client
+        limiter: RateLimiter shared by all requests
         model: Model name to use
 
     Returns:
-        Cleaned list of subjects as JSON array
+        Cleaned list of subjects as JSON array, or None if the response was not a list
     """
     if not subjects_list:
         return []
 
     # Convert list to JSON string for the prompt
-    subjects_json = json.dumps(subjects_list)
+    subjects_json = orjson.dumps(subjects_list).decode()
 
     contents = [
         types.Content(
@@ -38,110 +226,244 @@ def clean_subjects_with_gemini(subjects_list, client, model="gemini-flash-latest
         ),
     ]
 
+    max_output_tokens = max_output_tokens_for(subjects_json)
+
     generate_content_config = types.GenerateContentConfig(
         thinking_config=types.ThinkingConfig(
-            thinking_budget=-1,
+            thinking_budget=0,
         ),
+        temperature=0,
+        max_output_tokens=max_output_tokens,
         response_mime_type="application/json",
         system_instruction=[
-            types.Part.from_text(text="""You are given a list of book subject headings, the task to to remove any heading that is non-english and or not content based, for example AUDIOBOOK or LARGE PRINT are not valid content based subject headings.
-Remove any audience modifiers from the headings like JUVENILE FICTION or YOUNG ADULT FICTION and when them remove consolidate the headings if any of them are the same without those modifiers
-
-Return the JSON array of headings with only the good headings."""),
+            types.Part.from_text(text=SYSTEM_INSTRUCTION + "\n\nReturn the JSON array of headings with only the good headings."),
         ],
     )
 
-    # Collect the full response
-    response_text = ""
-    for chunk in client.models.generate_content_stream(
-        model=model,
-        contents=contents,
-        config=generate_content_config,
-    ):
-        if chunk.text:
-            response_text += chunk.text
+    # Rough token estimate for the prompt plus the largest allowed response
+    estimated_tokens = len(subjects_json) // 4 + max_output_tokens
+
+    response = await generate_with_retries(
+        client, limiter, model, contents, generate_content_config, estimated_tokens
+    )
+    response_text = response.text or ""
 
     # Parse the JSON response
     try:
-        cleaned_subjects = json.loads(response_text)
-        return cleaned_subjects if isinstance(cleaned_subjects, list) else []
-    except json.JSONDecodeError as e:
+        cleaned_subjects = orjson.loads(response_text)
+    except orjson.JSONDecodeError as e:
         print(f"    Error parsing Gemini response: {e}")
         print(f"    Response was: {response_text[:200]}...")
         return subjects_list  # Return original if parsing fails
 
+    # Anything but a list is a bad response, not "no good headings"; don't cache it
+    if not isinstance(cleaned_subjects, list):
+        print(f"    Gemini response was not a list: {response_text[:200]}...")
+        return None
 
-def main():
-    """Process all books and clean their subjects."""
-    api_key = os.environ.get("GEMINI_API_KEY")
+    save_cached_subjects(subjects_list, cleaned_subjects)
+    return cleaned_subjects
 
-    if not api_key:
-        print("Error: GEMINI_API_KEY environment variable not set")
-        print("Please set it with: export GEMINI_API_KEY='your-api-key'")
-        return
 
-    # Initialize Gemini client
-    client = genai.Client(api_key=api_key)
+async def clean_subject_batch(subjects_lists, client, limiter, model="gemini-flash-latest"):
+    """
+    Clean several books' subjects with a single Gemini request.
 
-    base_dir = Path('data')
-    books_file = base_dir / 'books_by_title.json'
-    output_file = base_dir / 'books_by_title.json'
+    Args:
+        subjects_lists: List of subject heading lists, one per book
+        client: Google GenAI client
+        limiter: RateLimiter shared by all requests
+        model: Model name to use
 
-    # Load books data
-    print(f"Loading books from {books_file}...")
-    with open(books_file, 'r', encoding='utf-8') as f:
-        books = json.load(f)
+    Returns:
+        List of cleaned subject lists aligned with subjects_lists, with None for
+        any item missing from the response (or for every item if it did not parse)
+    """
+    items = [{'id': i, 'subjects': subjects} for i, subjects in enumerate(subjects_lists)]
+    items_json = orjson.dumps({'items': items}).decode()
 
-    print(f"Found {len(books)} books to process\n")
+    contents = [
+        types.Content(
+            role="user",
+            parts=[
+                types.Part.from_text(text=items_json),
+            ],
+        ),
+    ]
+
+    max_output_tokens = max_output_tokens_for(items_json)
+
+    generate_content_config = types.GenerateContentConfig(
+        thinking_config=types.ThinkingConfig(
+            thinking_budget=0,
+        ),
+        temperature=0,
+        max_output_tokens=max_output_tokens,
+        response_mime_type="application/json",
+        response_schema=CleanedBatch,
+        system_instruction=[
+            types.Part.from_text(text=BATCH_SYSTEM_INSTRUCTION),
+        ],
+    )
+
+    # Rough token estimate for the prompt plus the largest allowed response
+    estimated_tokens = len(items_json) // 4 + max_output_tokens
+
+    response = await generate_with_retries(
+        client, limiter, model, contents, generate_content_config, estimated_tokens
+    )
+
+    # The SDK parses schema-typed output into a CleanedBatch, or None if it didn't validate
+    results = [None] * len(subjects_lists)
+    batch = response.parsed
+    if not isinstance(batch, CleanedBatch):
+        print(f"    Error parsing Gemini batch response: {(response.text or '')[:200]}...")
+        return results
+
+    for result in batch.results:
+        if 0 <= result.id < len(results):
+            results[result.id] = result.subjects
+            save_cached_subjects(subjects_lists[result.id], result.subjects)
+
+    return results
+
+
+async def process_batch(batch, client, semaphore, limiter, checkpoint, counts):
+    """Clean a batch of books in one request, falling back to one request per book for any it missed."""
+    subjects_lists = [book_data['metadata']['subjects'] for _, book_data in batch]
+
+    # Identical subject lists were already cleaned by an earlier call
+    results = [load_cached_subjects(subjects) for subjects in subjects_lists]
+    misses = [i for i, cleaned_subjects in enumerate(results) if cleaned_subjects is None]
+    counts['cached'] += len(batch) - len(misses)
+
+    if misses:
+        try:
+            async with semaphore:
+                cleaned = await clean_subject_batch([subjects_lists[i] for i in misses], client, limiter)
+        except Exception as e:
+            print(f"  Batch of {len(misses)} books failed ({e}), cleaning individually")
+            cleaned = [None] * len(misses)
+
+        for i, cleaned_subjects in zip(misses, cleaned):
+            results[i] = cleaned_subjects
+
+    for (book_id, book_data), subjects, cleaned_subjects in zip(batch, subjects_lists, results):
+        title = book_data.get('title', 'Unknown')
+
+        try:
+            if cleaned_subjects is None:
+                # Missing from the batch response, so one bad item doesn't poison the batch
+                async with semaphore:
+                    cleaned_subjects = await clean_subjects_with_gemini(subjects, client, limiter)
+                if cleaned_subjects is None:
+                    # Left out of the checkpoint so the next run tries this book again
+                    raise ValueError("Gemini did not return a list of subjects")
+
+            # Add cleaned subjects to metadata
+            book_data['metadata']['subjects_clean'] = cleaned_subjects
+
+            print(f"[{book_id}] {title}")
+            print(f"  Original subjects: {len(subjects)}")
+            print(f"  Cleaned subjects: {len(cleaned_subjects)}")
+            print(f"  ✓ Cleaned and saved")
+            counts['processed'] += 1
+
+            # Log each book to the checkpoint to avoid losing progress
+            await checkpoint.append(book_id, cleaned_subjects)
 
-    processed_count = 0
-    skipped_count = 0
-    error_count = 0
+        except Exception as e:
+            print(f"[{book_id}] {title}")
+            print(f"  ✗ Error processing: {e}")
+            counts['errors'] += 1
 
+
+async def process_books(books, client, checkpoint):
+    """Clean all books in batches of BATCH_SIZE, bounded by MAX_CONCURRENT_REQUESTS and the Gemini quota."""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+    counts = {'processed': 0, 'cached': 0, 'skipped': 0, 'errors': 0}
+
+    pending = []
     for book_id, book_data in books.items():
         title = book_data.get('title', 'Unknown')
         metadata = book_data.get('metadata', {})
-        subjects = metadata.get('subjects', [])
 
         # Skip if already cleaned or no subjects
         if 'subjects_clean' in metadata:
             print(f"[{book_id}] {title}: Already cleaned, skipping")
-            skipped_count += 1
+            counts['skipped'] += 1
             continue
 
-        if not subjects:
+        if not metadata.get('subjects'):
             print(f"[{book_id}] {title}: No subjects, skipping")
-            skipped_count += 1
+            counts['skipped'] += 1
             continue
 
-        print(f"[{book_id}] {title}")
-        print(f"  Original subjects: {len(subjects)}")
+        pending.append((book_id, book_data))
 
-        try:
-            # Clean subjects using Gemini
-            cleaned_subjects = clean_subjects_with_gemini(subjects, client)
+    await asyncio.gather(*(
+        process_batch(pending[i:i + BATCH_SIZE], client, semaphore, limiter, checkpoint, counts)
+        for i in range(0, len(pending), BATCH_SIZE)
+    ))
 
-            # Add cleaned subjects to metadata
-            metadata['subjects_clean'] = cleaned_subjects
+    return counts
 
-            print(f"  Cleaned subjects: {len(cleaned_subjects)}")
-            print(f"  ✓ Cleaned and saved")
-            processed_count += 1
 
-            # Save after each book to avoid losing progress
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(books, f, indent=2, ensure_ascii=False)
+def main():
+    """Process all books and clean their subjects."""
+    api_key = os.environ.get("GEMINI_API_KEY")
 
-        except Exception as e:
-            print(f"  ✗ Error processing: {e}")
-            error_count += 1
+    if not api_key:
+        print("Error: GEMINI_API_KEY environment variable not set")
+        print("Please set it with: export GEMINI_API_KEY='your-api-key'")
+        return
+
+    # Initialize Gemini client, shared by all requests
+    client = genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(timeout=REQUEST_TIMEOUT_MS),
+    )
+
+    base_dir = Path('data')
+    books_file = base_dir / 'books_by_title.json'
+    output_file = base_dir / 'books_by_title.json'
+
+    # Load books data
+    print(f"Loading books from {books_file}...")
+    with open(books_file, 'rb') as f:
+        books = orjson.loads(f.read())
+
+    print(f"Found {len(books)} books to process\n")
+
+    # Resume from books cleaned by a previous run that did not finish
+    checkpoint = Checkpoint(base_dir / 'subjects_clean.jsonl')
+    completed = checkpoint.load()
+    if completed:
+        print(f"Resuming with {len(completed)} books from {checkpoint.path}\n")
+        apply_cleaned_subjects(books, completed)
+
+    GEMINI_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+    checkpoint.open()
+    try:
+        counts = asyncio.run(process_books(books, client, checkpoint))
+    finally:
+        checkpoint.close()
+
+        # Merge the checkpoint and write the books file once
+        apply_cleaned_subjects(books, checkpoint.load())
+        print(f"\nWriting {output_file}...")
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(books, option=orjson.OPT_INDENT_2))
+        checkpoint.path.unlink()
 
     print(f"\n{'='*60}")
     print(f"Summary:")
     print(f"  Total books: {len(books)}")
-    print(f"  Processed: {processed_count}")
-    print(f"  Skipped: {skipped_count}")
-    print(f"  Errors: {error_count}")
+    print(f"  Processed: {counts['processed']} ({counts['cached']} from cache)")
+    print(f"  Skipped: {counts['skipped']}")
+    print(f"  Errors: {counts['errors']}")
     print(f"  Output: {output_file}")
     print(f"{'='*60}")
 
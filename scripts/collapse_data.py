@@ -6,108 +6,89 @@ Collapse refined_data_all.csv into two JSON files:
 """
 
 import csv
-import json
+import functools
+import orjson
 from pathlib import Path
 from collections import defaultdict
+from operator import itemgetter
+
+
+# Merged metadata fields in output order, with the CSV columns each is built
+# from and whether it is a list merged from pipe-separated values
+METADATA_FIELDS = (
+    ('title', ('Title',), False),
+    ('author', ('Author',), False),
+    ('secondary_authors', ('Secondary Author(s)',), False),
+    ('illustrators', ('Illustrator(s)',), False),
+    ('translators', ('Translator(s)',), False),
+    ('series', ('Series',), False),
+    ('formats', ('Format',), True),
+    ('isbns', ('ISBN', 'ISBN2', 'ISBN Cluster'), True),
+    ('oclc_numbers', ('OCLC Number', 'OCLC'), True),
+    ('lccn', ('LCCN', 'LCCN2'), True),
+    ('lc_classification', ('Library of Congress Classification',), True),
+    ('dewey_decimal', ('Dewey Decimal Classification',), True),
+    ('mode_titles', ('Mode Title', 'Mode Title2', 'Mode Title3'), True),
+    ('title_oclc', ('oclc_title',), False),
+    ('title_google', ('title_google',), False),
+    ('title_lc', ('title_LC',), False),
+    ('subjects', ('Subjects', 'Subject Headings'), True),
+    ('genres', ('Genres',), True),
+    ('work_uris', ('Work URI',), True),
+    ('description', ('Description',), False),
+    ('page_counts', ('Page Count',), True),
+)
+
+# Metadata fields holding lists, merged across all rows of a title
+LIST_FIELDS = tuple(field for field, _, is_list in METADATA_FIELDS if is_list)
+
+
+@functools.lru_cache(maxsize=None)
+def split_pipe_separated_value(value):
+    """Split one pipe-separated value into its stripped, non-empty, unique items."""
+    return tuple(dict.fromkeys(item for item in map(str.strip, value.split('|')) if item))
 
 
 def merge_pipe_separated_values(*values):
     """Merge multiple pipe-separated values, removing duplicates."""
-    all_items = []
-    for value in values:
-        if value and value.strip():
-            items = [item.strip() for item in value.split('|')]
-            all_items.extend(items)
-
-    # Remove duplicates while preserving order
-    seen = set()
-    unique_items = []
-    for item in all_items:
-        if item and item not in seen:
-            seen.add(item)
-            unique_items.append(item)
-
-    return unique_items
+    values = [value for value in values if value]
+    if len(values) <= 1:
+        return list(split_pipe_separated_value(values[0])) if values else []
+
+    # dict.fromkeys keeps the first occurrence of each item, in order
+    return list(dict.fromkeys(
+        item
+        for value in values
+        for item in split_pipe_separated_value(value)
+    ))
+
+
+def column_indexes(header, column_names):
+    """
+    Map column names to positions in the header.
+    Columns missing from the header map to len(header), a blank cell appended to every row.
+    """
+    positions = {name: i for i, name in enumerate(header)}
+    return tuple(positions.get(name, len(header)) for name in column_names)
+
+
+def build_field_indexes(header):
+    """Resolve METADATA_FIELDS to (field, column indexes, is_list) for this header."""
+    return tuple(
+        (field, column_indexes(header, columns), is_list)
+        for field, columns, is_list in METADATA_FIELDS
+    )
 
 
-def merge_fields(row):
+def merge_fields(row, field_indexes):
     """Merge related fields from different sources into consolidated fields."""
     merged = {}
 
-    # Title - use the main Title field
-    merged['title'] = row.get('Title', '').strip()
-
-    # Author
-    merged['author'] = row.get('Author', '').strip()
-    merged['secondary_authors'] = row.get('Secondary Author(s)', '').strip()
-    merged['illustrators'] = row.get('Illustrator(s)', '').strip()
-    merged['translators'] = row.get('Translator(s)', '').strip()
-
-    # Series
-    merged['series'] = row.get('Series', '').strip()
-
-    # Format
-    merged['formats'] = merge_pipe_separated_values(row.get('Format', ''))
-
-    # ISBN - merge ISBN, ISBN2, ISBN Cluster
-    merged['isbns'] = merge_pipe_separated_values(
-        row.get('ISBN', ''),
-        row.get('ISBN2', ''),
-        row.get('ISBN Cluster', '')
-    )
-
-    # OCLC Numbers
-    merged['oclc_numbers'] = merge_pipe_separated_values(
-        row.get('OCLC Number', ''),
-        row.get('OCLC', '')
-    )
-
-    # LCCN
-    merged['lccn'] = merge_pipe_separated_values(
-        row.get('LCCN', ''),
-        row.get('LCCN2', '')
-    )
-
-    # Library of Congress Classification
-    merged['lc_classification'] = merge_pipe_separated_values(
-        row.get('Library of Congress Classification', '')
-    )
-
-    # Dewey Decimal
-    merged['dewey_decimal'] = merge_pipe_separated_values(
-        row.get('Dewey Decimal Classification', '')
-    )
-
-    # Mode Title - merge Mode Title, Mode Title2, Mode Title3
-    mode_titles = merge_pipe_separated_values(
-        row.get('Mode Title', ''),
-        row.get('Mode Title2', ''),
-        row.get('Mode Title3', '')
-    )
-    merged['mode_titles'] = mode_titles
-
-    # Title variations
-    merged['title_oclc'] = row.get('oclc_title', '').strip()
-    merged['title_google'] = row.get('title_google', '').strip()
-    merged['title_lc'] = row.get('title_LC', '').strip()
-
-    # Subjects - merge Subjects and Subject Headings
-    merged['subjects'] = merge_pipe_separated_values(
-        row.get('Subjects', ''),
-        row.get('Subject Headings', '')
-    )
-
-    # Genres
-    merged['genres'] = merge_pipe_separated_values(row.get('Genres', ''))
-
-    # Work URI
-    merged['work_uris'] = merge_pipe_separated_values(row.get('Work URI', ''))
-
-    # Description
-    merged['description'] = row.get('Description', '').strip()
-
-    # Page Count
-    merged['page_counts'] = merge_pipe_separated_values(row.get('Page Count', ''))
+    for field, indexes, is_list in field_indexes:
+        if is_list:
+            merged[field] = merge_pipe_separated_values(*[row[i] for i in indexes])
+        else:
+            merged[field] = row[indexes[0]].strip()
 
     return merged
 
@@ -124,7 +105,9 @@ def main():
     # Data structures
     books_by_title = defaultdict(lambda: {
         'metadata': None,
-        'bans': []
+        'bans': [],
+        'seen_metadata': set(),
+        'list_fields': defaultdict(dict)
     })
     books_by_district = defaultdict(list)
     title_to_id = {}  # Map titles to IDs
@@ -132,14 +115,29 @@ def main():
 
     # Read CSV
     with open(input_file, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
+        reader = csv.reader(f)
+        header = next(reader)
+        width = len(header)
+
+        field_indexes = build_field_indexes(header)
+        title_index, author_index, state_index, district_index, date_index, ban_status_index = column_indexes(
+            header, ('Title', 'Author', 'State', 'District', 'Date of Challenge/Removal', 'Ban Status')
+        )
+
+        # Every column merge_fields reads; rows of a title that agree on all of them merge to nothing new
+        metadata_values_of = itemgetter(*sorted({i for _, indexes, _ in field_indexes for i in indexes}))
 
         for row in reader:
-            title = row.get('Title', '').strip()
-            state = row.get('State', '').strip()
-            district = row.get('District', '').strip()
-            date = row.get('Date of Challenge/Removal', '').strip()
-            ban_status = row.get('Ban Status', '').strip()
+            # Pad short rows, then add the blank cell that missing columns point at
+            if len(row) < width:
+                row += [''] * (width - len(row))
+            row.append('')
+
+            title = row[title_index].strip()
+            state = row[state_index].strip()
+            district = row[district_index].strip()
+            date = row[date_index].strip()
+            ban_status = row[ban_status_index].strip()
 
             if not title:
                 continue
@@ -151,35 +149,36 @@ def main():
 
             book_id = title_to_id[title]
 
-            # Merge fields for this row
-            merged_metadata = merge_fields(row)
-
-            # Update books_by_title
-            if books_by_title[title]['metadata'] is None:
-                books_by_title[title]['metadata'] = merged_metadata
+            # Rows repeating a title's metadata (one per district) have nothing new to merge
+            metadata_values = metadata_values_of(row)
+            seen_metadata = books_by_title[title]['seen_metadata']
+            if metadata_values in seen_metadata:
+                author = row[author_index].strip()
             else:
-                # Merge arrays from multiple rows of the same title
-                existing = books_by_title[title]['metadata']
-
-                # Merge list fields
-                for field in ['formats', 'isbns', 'oclc_numbers', 'lccn', 'lc_classification',
-                              'dewey_decimal', 'mode_titles', 'subjects', 'genres',
-                              'work_uris', 'page_counts']:
-                    if field in merged_metadata:
-                        combined = existing[field] + merged_metadata[field]
-                        # Remove duplicates
-                        seen = set()
-                        unique = []
-                        for item in combined:
-                            if item not in seen:
-                                seen.add(item)
-                                unique.append(item)
-                        existing[field] = unique
-
-                # Keep longer description if available
-                if merged_metadata.get('description') and \
-                   len(merged_metadata['description']) > len(existing.get('description', '')):
-                    existing['description'] = merged_metadata['description']
+                seen_metadata.add(metadata_values)
+
+                # Merge fields for this row
+                merged_metadata = merge_fields(row, field_indexes)
+                author = merged_metadata.get('author', '')
+
+                # Update books_by_title
+                if books_by_title[title]['metadata'] is None:
+                    books_by_title[title]['metadata'] = merged_metadata
+                else:
+                    existing = books_by_title[title]['metadata']
+
+                    # Keep longer description if available
+                    if merged_metadata.get('description') and \
+                       len(merged_metadata['description']) > len(existing.get('description', '')):
+                        existing['description'] = merged_metadata['description']
+
+                # Merge arrays from multiple rows of the same title into
+                # insertion-ordered dicts, used as ordered sets
+                list_fields = books_by_title[title]['list_fields']
+                for field in LIST_FIELDS:
+                    accumulator = list_fields[field]
+                    for item in merged_metadata[field]:
+                        accumulator[item] = None
 
             # Add ban information
             ban_info = {
@@ -195,12 +194,17 @@ def main():
             book_entry = {
                 'id': book_id,
                 'title': title,
-                'author': merged_metadata.get('author', ''),
+                'author': author,
                 'date': date,
                 'ban_status': ban_status
             }
             books_by_district[district_key].append(book_entry)
 
+    # Turn the accumulated list fields back into lists
+    for data in books_by_title.values():
+        for field, accumulator in data['list_fields'].items():
+            data['metadata'][field] = list(accumulator)
+
     # Convert defaultdicts to regular dicts for JSON serialization with IDs
     books_by_title_output = {
         title_to_id[title]: {
@@ -216,12 +220,13 @@ def main():
 
     # Write JSON files
     print(f"\nWriting {output_by_title}...")
-    with open(output_by_title, 'w', encoding='utf-8') as f:
-        json.dump(books_by_title_output, f, indent=2, ensure_ascii=False)
+    with open(output_by_title, 'wb') as f:
+        # Title IDs are int keys
+        f.write(orjson.dumps(books_by_title_output, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
 
     print(f"Writing {output_by_district}...")
-    with open(output_by_district, 'w', encoding='utf-8') as f:
-        json.dump(books_by_district_output, f, indent=2, ensure_ascii=False)
+    with open(output_by_district, 'wb') as f:
+        f.write(orjson.dumps(books_by_district_output, option=orjson.OPT_INDENT_2))
 
     print(f"\n✓ Successfully created JSON files:")
     print(f"  - Unique titles: {len(books_by_title_output)}")
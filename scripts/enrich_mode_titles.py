@@ -5,26 +5,27 @@ For rows missing Mode Title, Mode Title2, or Mode Title3, look up the data from
 """
 
 import csv
+import functools
 from pathlib import Path
 
 
-def read_csv_as_dict(file_path):
-    """Read CSV file and return list of dictionaries."""
-    with open(file_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        return list(reader), reader.fieldnames
+MODE_TITLE_COLUMNS = ('Mode Title', 'Mode Title2', 'Mode Title3')
 
 
+@functools.lru_cache(maxsize=None)
 def normalize_title(title):
     """Normalize title for comparison."""
     return title.strip().lower()
 
 
-def build_pass_two_lookup(pass_two_data):
-    """Build a lookup dictionary from pass two data using combined title + parenthetical."""
+def build_pass_two_lookup(pass_two_rows):
+    """
+    Build a lookup dictionary from pass two rows using combined title + parenthetical.
+    Only the Mode Title values are kept, as a tuple in MODE_TITLE_COLUMNS order.
+    """
     lookup = {}
 
-    for row in pass_two_data:
+    for row in pass_two_rows:
         title = row.get('Title', '').strip()
         parenthetical = row.get('title_parenthetical', '').strip()
 
@@ -36,7 +37,7 @@ def build_pass_two_lookup(pass_two_data):
 
         # Normalize for lookup
         key = normalize_title(combined_title)
-        lookup[key] = row
+        lookup[key] = tuple(row.get(column) or '' for column in MODE_TITLE_COLUMNS)
 
     return lookup
 
@@ -53,61 +54,53 @@ def main():
     pass_two_file = base_dir / 'refined_data_pass_two_enriched.csv'
     output_file = base_dir / 'refined_data_all.csv'
 
-    # Read both files
-    print("Reading pass one data...")
-    pass_one_data, pass_one_fields = read_csv_as_dict(pass_one_file)
-
+    # Build lookup from pass two, streaming its rows
     print("Reading pass two enriched data...")
-    pass_two_data, pass_two_fields = read_csv_as_dict(pass_two_file)
+    with open(pass_two_file, 'r', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
 
-    # Build lookup from pass two
-    print("Building lookup index from pass two data...")
-    pass_two_lookup = build_pass_two_lookup(pass_two_data)
+        print("Building lookup index from pass two data...")
+        pass_two_lookup = build_pass_two_lookup(reader)
     print(f"  Created lookup with {len(pass_two_lookup)} entries")
 
-    # Process pass one data
+    # Process pass one data, writing each row as it is read
+    total_count = 0
     enriched_count = 0
     not_found_count = 0
 
     print("\nProcessing pass one data...")
-    for row in pass_one_data:
-        title = row.get('Title', '').strip()
-
-        # Check if Mode Title columns are empty
-        mode_title = row.get('Mode Title', '')
-        mode_title2 = row.get('Mode Title2', '')
-        mode_title3 = row.get('Mode Title3', '')
-
-        if is_empty(mode_title) and is_empty(mode_title2) and is_empty(mode_title3):
-            # Look up in pass two data
-            key = normalize_title(title)
-
-            if key in pass_two_lookup:
-                pass_two_row = pass_two_lookup[key]
-
-                # Copy Mode Title values from pass two
-                if 'Mode Title' in pass_two_fields and pass_two_row.get('Mode Title'):
-                    row['Mode Title'] = pass_two_row['Mode Title']
-                if 'Mode Title2' in pass_two_fields and pass_two_row.get('Mode Title2'):
-                    row['Mode Title2'] = pass_two_row['Mode Title2']
-                if 'Mode Title3' in pass_two_fields and pass_two_row.get('Mode Title3'):
-                    row['Mode Title3'] = pass_two_row['Mode Title3']
-
-                enriched_count += 1
-                print(f"  ✓ Enriched: {title}")
-            else:
-                not_found_count += 1
-                print(f"  ✗ Not found: {title}")
-
-    # Write enriched data
-    print(f"\nWriting enriched data to {output_file}...")
-    with open(output_file, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=pass_one_fields)
+    print(f"Writing enriched data to {output_file}...")
+    with open(pass_one_file, 'r', encoding='utf-8') as infile, \
+         open(output_file, 'w', newline='', encoding='utf-8') as outfile:
+        reader = csv.DictReader(infile)
+        writer = csv.DictWriter(outfile, fieldnames=reader.fieldnames)
         writer.writeheader()
-        writer.writerows(pass_one_data)
+
+        for row in reader:
+            total_count += 1
+            title = row.get('Title', '').strip()
+
+            # Check if Mode Title columns are empty
+            if all(is_empty(row.get(column)) for column in MODE_TITLE_COLUMNS):
+                # Look up in pass two data
+                key = normalize_title(title)
+
+                if key in pass_two_lookup:
+                    # Copy Mode Title values from pass two
+                    for column, value in zip(MODE_TITLE_COLUMNS, pass_two_lookup[key]):
+                        if value:
+                            row[column] = value
+
+                    enriched_count += 1
+                    print(f"  ✓ Enriched: {title}")
+                else:
+                    not_found_count += 1
+                    print(f"  ✗ Not found: {title}")
+
+            writer.writerow(row)
 
     print(f"\n✓ Successfully enriched data:")
-    print(f"  - Total rows in pass one: {len(pass_one_data)}")
+    print(f"  - Total rows in pass one: {total_count}")
     print(f"  - Rows enriched with Mode Title data: {enriched_count}")
     print(f"  - Rows not found in pass two: {not_found_count}")
     print(f"  - Output file: {output_file}")
@@ -9,6 +9,11 @@ import re
 import sys
 
 
+# Parenthetical expressions with their surrounding whitespace
+PARENTHETICAL_RE = re.compile(r'\s*\([^)]*\)\s*')
+WHITESPACE_RE = re.compile(r'\s+')
+
+
 def extract_parenthetical(title):
     """
     Extract parenthetical text from title and return cleaned title and parenthetical text.
@@ -22,13 +27,15 @@ def extract_parenthetical(title):
     if not title:
         return '', ''
 
-    # Find all parenthetical expressions
-    pattern = r'\s*\([^)]*\)\s*'
-    parentheticals = re.findall(pattern, title)
+    # Remove parentheticals, collecting them in the same pass
+    parentheticals = []
+
+    def collect(match):
+        parentheticals.append(match.group(0))
+        return ' '
 
-    # Remove parentheticals and strip
-    cleaned_title = re.sub(pattern, ' ', title)
-    cleaned_title = ' '.join(cleaned_title.split()).strip()
+    cleaned_title = PARENTHETICAL_RE.sub(collect, title)
+    cleaned_title = WHITESPACE_RE.sub(' ', cleaned_title).strip()
 
     # Combine all parenthetical text, strip whitespace
     parenthetical_text = ''.join(parentheticals).strip()
@@ -44,31 +51,35 @@ def main():
     input_file = sys.argv[1]
     output_file = sys.argv[2]
 
-    # Read input CSV
-    with open(input_file, 'r', encoding='utf-8') as infile:
-        reader = csv.DictReader(infile)
-        fieldnames = list(reader.fieldnames)
+    # Stream rows from input to output, splitting the title as we go
+    row_count = 0
+    with open(input_file, 'r', encoding='utf-8') as infile, \
+         open(output_file, 'w', encoding='utf-8', newline='') as outfile:
+        reader = csv.reader(infile)
+        writer = csv.writer(outfile)
 
         # Add new column after Title
+        fieldnames = next(reader)
+        column_count = len(fieldnames)
         title_index = fieldnames.index('Title')
         fieldnames.insert(title_index + 1, 'title_parenthetical')
+        writer.writerow(fieldnames)
 
-        rows = []
         for row in reader:
-            title = row.get('Title', '')
-            cleaned_title, parenthetical = extract_parenthetical(title)
+            # DictReader skipped blank lines
+            if not row:
+                continue
 
-            row['Title'] = cleaned_title
-            row['title_parenthetical'] = parenthetical
-            rows.append(row)
+            # Pad short rows to the header, as DictWriter would
+            if len(row) < column_count:
+                row += [''] * (column_count - len(row))
 
-    # Write output CSV
-    with open(output_file, 'w', encoding='utf-8', newline='') as outfile:
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(rows)
+            # Replace Title with (cleaned title, parenthetical)
+            row[title_index:title_index + 1] = extract_parenthetical(row[title_index])
+            writer.writerow(row)
+            row_count += 1
 
-    print(f"Processed {len(rows)} rows from {input_file} to {output_file}")
+    print(f"Processed {row_count} rows from {input_file} to {output_file}")
 
 
 if __name__ == '__main__':
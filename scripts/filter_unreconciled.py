@@ -13,13 +13,15 @@ def main():
     input_file = os.path.join('data', 'refined_data_pass_one.csv')
     output_file = os.path.join('data', 'refined_data_pass_two.csv')
 
-    # Read input CSV and filter rows
-    with open(input_file, 'r', encoding='utf-8') as infile:
+    # Stream rows from input to output, keeping only unreconciled ones
+    unreconciled_count = 0
+    with open(input_file, 'r', encoding='utf-8') as infile, \
+         open(output_file, 'w', encoding='utf-8', newline='') as outfile:
         reader = csv.DictReader(infile)
-        fieldnames = reader.fieldnames
+        writer = csv.DictWriter(outfile, fieldnames=reader.fieldnames)
+        writer.writeheader()
 
         # Filter rows where Mode Title, Mode Title2, and Mode Title3 are all empty
-        unreconciled_rows = []
         for row in reader:
             mode_title = row.get('Mode Title', '').strip()
             mode_title2 = row.get('Mode Title2', '').strip()
@@ -27,15 +29,10 @@ def main():
 
             # If all three Mode Title fields are empty, include this row
             if not mode_title and not mode_title2 and not mode_title3:
-                unreconciled_rows.append(row)
-
-    # Write filtered rows to output CSV
-    with open(output_file, 'w', encoding='utf-8', newline='') as outfile:
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(unreconciled_rows)
+                writer.writerow(row)
+                unreconciled_count += 1
 
-    print(f"Filtered {len(unreconciled_rows)} unreconciled rows to {output_file}")
+    print(f"Filtered {unreconciled_count} unreconciled rows to {output_file}")
 
 
 if __name__ == '__main__':
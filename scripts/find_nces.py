@@ -5,10 +5,26 @@ Adds a Qid column with the Wikidata ID if a match is found.
 """
 
 import csv
-import time
-import urllib.parse
-import urllib.request
+import hashlib
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from http_utils import USER_AGENT, rate_limiter_for, retrying_session
+
+
+# Number of districts looked up at once
+MAX_WORKERS = 5
+
+# Be respectful to Wikidata - cap the request rate across all workers
+REQUESTS_PER_SECOND = 5
+
+# Search results from earlier runs, one JSON file per district name
+WIKIDATA_CACHE_DIR = 'data/.wikidata_cache'
+
+# Shared session so every request reuses pooled keep-alive connections
+SESSION = retrying_session(pool_maxsize=10, user_agent=USER_AGENT)
+rate_limiter = rate_limiter_for('query.wikidata.org', REQUESTS_PER_SECOND)
 
 
 # State name normalization mapping
@@ -72,60 +88,70 @@ def state_matches(description, state):
             state_abbr.lower() in description_lower)
 
 
-def search_wikidata(district_name):
-    """
-    Search Wikidata for a school district.
+def sparql_string(text):
+    """Quote text as a SPARQL string literal."""
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
 
-    Args:
-        district_name: Name of the school district
 
-    Returns:
-        list: Search results from Wikidata
-    """
-    base_url = "https://www.wikidata.org/w/api.php"
-    params = {
-        'action': 'wbsearchentities',
-        'format': 'json',
-        'limit': '10',
-        'language': 'en',
-        'uselang': 'en',
-        'type': 'item',
-        'search': district_name
-    }
+def cache_path_for(district_name):
+    """Cache file for a district name's search results."""
+    key = hashlib.blake2b(district_name.encode(), digest_size=16).hexdigest()
+    return os.path.join(WIKIDATA_CACHE_DIR, f'{key}.json')
 
-    url = f"{base_url}?{urllib.parse.urlencode(params)}"
 
-    try:
-        req = urllib.request.Request(
-            url,
-            headers={'User-Agent': 'user: thisismattmiller - data scripts'}
-        )
-        with urllib.request.urlopen(req) as response:
-            data = json.loads(response.read().decode())
-            return data.get('search', [])
-    except Exception as e:
-        print(f"Error searching for {district_name}: {e}")
-        return []
+def load_cached_results(district_name):
+    """Return cached search results for a district name, or None on a cache miss."""
+    cache_path = cache_path_for(district_name)
+    if not os.path.exists(cache_path):
+        return None
+
+    with open(cache_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
 
 
-def get_nces_id(qid):
+def save_cached_results(district_name, results):
+    """Cache search results for a district name."""
+    with open(cache_path_for(district_name), 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False)
+
+
+def search_wikidata(district_name):
     """
-    Query Wikidata SPARQL endpoint to get NCES ID for a given QID.
+    Search Wikidata for a school district and fetch each result's NCES ID in the same query.
+
+    Uses the MWAPI EntitySearch service, which runs the same search as
+    wbsearchentities, so one SPARQL request replaces the search plus a
+    per-QID NCES lookup. Results are cached on disk by district name.
 
     Args:
-        qid: Wikidata QID (e.g., 'Q6524588')
+        district_name: Name of the school district
 
     Returns:
-        str: NCES ID if found, empty string otherwise
+        list: Results in search order, each a dict with 'id', 'description' and 'nces'
     """
+    cached = load_cached_results(district_name)
+    if cached is not None:
+        return cached
+
     sparql_endpoint = "https://query.wikidata.org/sparql"
 
     query = f"""
-    SELECT ?NCES
+    SELECT ?item ?description ?NCES ?num
     WHERE
     {{
-      wd:{qid} wdt:P2483 ?NCES.
+      SERVICE wikibase:mwapi {{
+        bd:serviceParam wikibase:endpoint "www.wikidata.org";
+                        wikibase:api "EntitySearch";
+                        mwapi:search {sparql_string(district_name)};
+                        mwapi:language "en";
+                        wikibase:limit 10.
+        ?item wikibase:apiOutputItem mwapi:item.
+        ?num wikibase:apiOrdinal true.
+      }}
+      OPTIONAL {{ ?item schema:description ?description. FILTER(LANG(?description) = "en") }}
+      OPTIONAL {{ ?item wdt:P2483 ?NCES. }}
     }}
+    ORDER BY ?num
     """
 
     params = {
@@ -133,44 +159,51 @@ def get_nces_id(qid):
         'format': 'json'
     }
 
-    url = f"{sparql_endpoint}?{urllib.parse.urlencode(params)}"
-
+    rate_limiter.wait()
     try:
-        req = urllib.request.Request(
-            url,
-            headers={'User-Agent': 'user: thisismattmiller - data scripts'}
-        )
-        with urllib.request.urlopen(req) as response:
-            data = json.loads(response.read().decode())
-            results = data.get('results', {}).get('bindings', [])
-
-            if results:
-                return results[0].get('NCES', {}).get('value', '')
-            return ''
+        response = SESSION.get(sparql_endpoint, params=params, timeout=20)
+        rate_limiter.observe(response)
+        response.raise_for_status()
+        data = response.json()
     except Exception as e:
-        print(f"    Error getting NCES ID for {qid}: {e}")
-        return ''
+        print(f"Error searching for {district_name}: {e}")
+        return []
+
+    # An item with several NCES IDs comes back once per ID, keep the first
+    results = {}
+    for binding in data.get('results', {}).get('bindings', []):
+        qid = binding['item']['value'].rsplit('/', 1)[-1]
+        if qid not in results:
+            results[qid] = {
+                'id': qid,
+                'description': binding.get('description', {}).get('value', ''),
+                'nces': binding.get('NCES', {}).get('value', ''),
+            }
 
+    # Only successful searches are cached, so errors are retried on the next run
+    results = list(results.values())
+    save_cached_results(district_name, results)
+    return results
 
-def find_qid_for_district(district_name, state):
+
+def lookup_district(district_name, state):
     """
-    Find the Wikidata QID for a school district by matching state in description.
+    Find the Wikidata QID and NCES ID for a school district by matching state in description.
 
     Args:
         district_name: Name of the school district
         state: State where the district is located
 
     Returns:
-        str: Wikidata QID if found, empty string otherwise
+        tuple: (qid, nces), empty strings where not found
     """
     results = search_wikidata(district_name)
 
     for result in results:
-        description = result.get('description', '')
-        if state_matches(description, state):
-            return result.get('id', '')
+        if state_matches(result['description'], state):
+            return result['id'], result['nces']
 
-    return ''
+    return '', ''
 
 
 def main():
@@ -181,49 +214,45 @@ def main():
     with open(input_file, 'r', encoding='utf-8') as infile:
         reader = csv.DictReader(infile)
         fieldnames = list(reader.fieldnames)
+        rows = list(reader)
+
+    # Add Qid and NCES columns if not present
+    if 'Qid' not in fieldnames:
+        fieldnames.append('Qid')
+    if 'NCES' not in fieldnames:
+        fieldnames.append('NCES')
 
-        # Add Qid and NCES columns if not present
-        if 'Qid' not in fieldnames:
-            fieldnames.append('Qid')
-        if 'NCES' not in fieldnames:
-            fieldnames.append('NCES')
+    os.makedirs(WIKIDATA_CACHE_DIR, exist_ok=True)
 
-        rows = []
-        for i, row in enumerate(reader, start=1):
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Start every lookup, then report them in input order
+        lookups = {}
+        for i, row in enumerate(rows, start=1):
             district = row.get('District', '').strip()
             state = row.get('State', '').strip()
-
             if district and state:
-                print(f"[{i}] Searching for: {district}, {state}")
-                qid = find_qid_for_district(district, state)
-
-                if qid:
-                    print(f"    Found QID: {qid}")
-                    row['Qid'] = qid
-
-                    # Get NCES ID from Wikidata
-                    nces = get_nces_id(qid)
-                    if nces:
-                        print(f"    Found NCES: {nces}")
-                        row['NCES'] = nces
-                    else:
-                        print(f"    No NCES ID found")
-                        row['NCES'] = ''
-
-                    # Rate limit for SPARQL query
-                    time.sleep(0.5)
-                else:
-                    print(f"    No match found")
-                    row['Qid'] = ''
-                    row['NCES'] = ''
+                lookups[i] = executor.submit(lookup_district, district, state)
 
-                # Be respectful to Wikidata API - rate limit requests
-                time.sleep(0.5)
-            else:
+        for i, row in enumerate(rows, start=1):
+            if i not in lookups:
                 row['Qid'] = ''
                 row['NCES'] = ''
+                continue
+
+            print(f"[{i}] Searching for: {row['District'].strip()}, {row['State'].strip()}")
+            qid, nces = lookups[i].result()
+
+            if qid:
+                print(f"    Found QID: {qid}")
+                if nces:
+                    print(f"    Found NCES: {nces}")
+                else:
+                    print(f"    No NCES ID found")
+            else:
+                print(f"    No match found")
 
-            rows.append(row)
+            row['Qid'] = qid
+            row['NCES'] = nces
 
     # Write output CSV
     with open(output_file, 'w', encoding='utf-8', newline='') as outfile:
@@ -6,10 +6,70 @@ Scrape NCES district data and combine with CSV data into a JSON file.
 import csv
 import json
 import re
-import time
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from html.parser import HTMLParser
 
+from http_utils import USER_AGENT, rate_limiter_for, retrying_session
+
+
+# Number of district pages fetched at once
+MAX_WORKERS = 8
+
+# Be polite to NCES - cap the request rate across all workers
+REQUESTS_PER_SECOND = 4
+
+# Shared session so every request reuses pooled keep-alive connections; NCES has
+# no published limit, so only back off when it says it is overloaded
+SESSION = retrying_session(pool_maxsize=20, status_forcelist=(429, 503), user_agent=USER_AGENT)
+rate_limiter = rate_limiter_for('nces.ed.gov', REQUESTS_PER_SECOND)
+
+
+# Label text on the district page -> (capture key, tag the label must be in)
+LABELS = {
+    'District Name:': ('district_name', None),
+    'NCES District ID:': ('nces_id', None),
+    'State District ID:': ('state_id', None),
+    'Mailing Address:': ('mailing_address', None),
+    'Physical Address:': ('physical_address', None),
+    'Phone:': ('phone', None),
+    'Type:': ('type', None),
+    'Status:': ('status', None),
+    'Total Schools:': ('total_schools', None),
+    'Grade Span:': ('grade_span', None),
+    'Website:': ('website', None),
+    'County:': ('county', 'th'),
+    'County ID:': ('county_id', None),
+    'Locale:': ('locale', 'th'),
+    'Total Students:': ('total_students', None),
+    'Student/Teacher Ratio:': ('student_teacher_ratio', None),
+    'Total Revenue:': ('total_revenue', None),
+    'Total Expenditures:': ('total_expenditures', None),
+}
+
+# Single-value fields: capture key -> (output field, tag the value must be in)
+SIMPLE_CAPTURES = {
+    'nces_id': ('NCES District ID', None),
+    'state_id': ('State District ID', None),
+    'phone': ('Phone', None),
+    'type': ('Type', None),
+    'status': ('Status', None),
+    'total_schools': ('Total Schools', None),
+    'grade_span': ('Grade Span', None),
+    'county': ('County', 'td'),
+    'county_id': ('County ID', 'td'),
+    'locale': ('Locale', 'td'),
+    'total_students': ('Total Students', 'td'),
+    'student_teacher_ratio': ('Student/Teacher Ratio', 'td'),
+    'total_revenue': ('Total Revenue', 'font'),
+    'total_expenditures': ('Total Expenditures', 'font'),
+}
+
+# Address fields are built from the next two text nodes
+ADDRESS_CAPTURES = {
+    'mailing_address': 'Mailing Address',
+    'physical_address': 'Physical Address',
+}
+
 
 class NCESDistrictParser(HTMLParser):
     """Parse NCES district detail page."""
@@ -33,138 +93,63 @@ class NCESDistrictParser(HTMLParser):
         if not data:
             return
 
-        # District Name
-        if 'District Name:' in data:
-            self.capture_next = 'district_name'
-        elif self.capture_next == 'district_name' and data not in ['District Name:', '(Schools in this District)']:
-            self.data['District Name'] = data
-            self.capture_next = None
-
-        # NCES District ID
-        elif 'NCES District ID:' in data:
-            self.capture_next = 'nces_id'
-        elif self.capture_next == 'nces_id':
-            self.data['NCES District ID'] = data
-            self.capture_next = None
-
-        # State District ID
-        elif 'State District ID:' in data:
-            self.capture_next = 'state_id'
-        elif self.capture_next == 'state_id':
-            self.data['State District ID'] = data
-            self.capture_next = None
-
-        # Mailing Address
-        elif 'Mailing Address:' in data:
-            self.capture_next = 'mailing_address'
-            self.temp_data['mailing_parts'] = []
-        elif self.capture_next == 'mailing_address' and data != 'Mailing Address:':
-            self.temp_data['mailing_parts'].append(data)
-            if len(self.temp_data['mailing_parts']) >= 2:
-                self.data['Mailing Address'] = ' '.join(self.temp_data['mailing_parts'])
-                self.capture_next = None
-
-        # Physical Address
-        elif 'Physical Address:' in data:
-            self.capture_next = 'physical_address'
-            self.temp_data['physical_parts'] = []
-        elif self.capture_next == 'physical_address' and 'Physical Address:' not in data and 'Map latest data' not in data:
-            self.temp_data['physical_parts'].append(data)
-            if len(self.temp_data['physical_parts']) >= 2:
-                self.data['Physical Address'] = ' '.join(self.temp_data['physical_parts'])
-                self.capture_next = None
-
-        # Phone
-        elif 'Phone:' in data:
-            self.capture_next = 'phone'
-        elif self.capture_next == 'phone':
-            self.data['Phone'] = data
-            self.capture_next = None
-
-        # Type
-        elif 'Type:' in data:
-            self.capture_next = 'type'
-        elif self.capture_next == 'type':
-            self.data['Type'] = data
-            self.capture_next = None
-
-        # Status
-        elif 'Status:' in data:
-            self.capture_next = 'status'
-        elif self.capture_next == 'status':
-            self.data['Status'] = data
-            self.capture_next = None
-
-        # Total Schools
-        elif 'Total Schools:' in data:
-            self.capture_next = 'total_schools'
-        elif self.capture_next == 'total_schools':
-            self.data['Total Schools'] = data
-            self.capture_next = None
-
-        # Grade Span
-        elif 'Grade Span:' in data:
-            self.capture_next = 'grade_span'
-        elif self.capture_next == 'grade_span':
-            self.data['Grade Span'] = data
-            self.capture_next = None
+        # A label always starts a new capture, so an empty field can't swallow the next one
+        label = LABELS.get(data)
+        if label is not None:
+            key, required_tag = label
+            if not required_tag or self.current_tag == required_tag:
+                self.capture_next = key
+                if key in ADDRESS_CAPTURES:
+                    self.temp_data[key] = []
+                return
+
+        # Otherwise a label earlier on the page may be waiting for its value
+        if self.capture_next in SIMPLE_CAPTURES:
+            self.capture_simple(data)
+        elif self.capture_next is not None:
+            self.CAPTURE_HANDLERS[self.capture_next](self, data)
+
+    def capture_simple(self, data):
+        field, required_tag = SIMPLE_CAPTURES[self.capture_next]
+        if required_tag and self.current_tag != required_tag:
+            return
+        # Revenue/expenditure values are the dollar amounts inside <font>
+        if required_tag == 'font' and '$' not in data:
+            return
 
-        # Website
-        elif 'Website:' in data:
-            self.capture_next = 'website'
-        elif self.capture_next == 'website' and data != 'Website:':
-            if data.startswith('http'):
-                self.data['Website'] = data
-                self.capture_next = None
-
-        # County
-        elif 'County:' in data and self.current_tag == 'th':
-            self.capture_next = 'county'
-        elif self.capture_next == 'county' and self.current_tag == 'td':
-            self.data['County'] = data
-            self.capture_next = None
+        self.data[field] = data
+        self.capture_next = None
 
-        # County ID
-        elif 'County ID:' in data:
-            self.capture_next = 'county_id'
-        elif self.capture_next == 'county_id' and self.current_tag == 'td':
-            self.data['County ID'] = data
-            self.capture_next = None
+    def capture_district_name(self, data):
+        if data == '(Schools in this District)':
+            return
 
-        # Locale
-        elif 'Locale:' in data and self.current_tag == 'th':
-            self.capture_next = 'locale'
-        elif self.capture_next == 'locale' and self.current_tag == 'td':
-            self.data['Locale'] = data
-            self.capture_next = None
+        self.data['District Name'] = data
+        self.capture_next = None
 
-        # Total Students
-        elif 'Total Students:' in data:
-            self.capture_next = 'total_students'
-        elif self.capture_next == 'total_students' and self.current_tag == 'td':
-            self.data['Total Students'] = data
-            self.capture_next = None
+    def capture_address(self, data):
+        key = self.capture_next
+        if 'Map latest data' in data:
+            return
 
-        # Student/Teacher Ratio
-        elif 'Student/Teacher Ratio:' in data:
-            self.capture_next = 'student_teacher_ratio'
-        elif self.capture_next == 'student_teacher_ratio' and self.current_tag == 'td':
-            self.data['Student/Teacher Ratio'] = data
+        parts = self.temp_data[key]
+        parts.append(data)
+        if len(parts) >= 2:
+            self.data[ADDRESS_CAPTURES[key]] = ' '.join(parts)
             self.capture_next = None
 
-        # Total Revenue
-        elif 'Total Revenue:' in data:
-            self.capture_next = 'total_revenue'
-        elif self.capture_next == 'total_revenue' and self.current_tag == 'font' and '$' in data:
-            self.data['Total Revenue'] = data
+    def capture_website(self, data):
+        # Skip anything between the label and the link itself
+        if data.startswith('http'):
+            self.data['Website'] = data
             self.capture_next = None
 
-        # Total Expenditures
-        elif 'Total Expenditures:' in data:
-            self.capture_next = 'total_expenditures'
-        elif self.capture_next == 'total_expenditures' and self.current_tag == 'font' and '$' in data:
-            self.data['Total Expenditures'] = data
-            self.capture_next = None
+    CAPTURE_HANDLERS = {
+        'district_name': capture_district_name,
+        'mailing_address': capture_address,
+        'physical_address': capture_address,
+        'website': capture_website,
+    }
 
 
 def scrape_nces_data(nces_id):
@@ -179,13 +164,12 @@ def scrape_nces_data(nces_id):
     """
     url = f"https://nces.ed.gov/ccd/districtsearch/district_detail.asp?ID2={nces_id}"
 
+    rate_limiter.wait()
     try:
-        req = urllib.request.Request(
-            url,
-            headers={'User-Agent': 'user: thisismattmiller - data scripts'}
-        )
-        with urllib.request.urlopen(req) as response:
-            html = response.read().decode('utf-8', errors='ignore')
+        response = SESSION.get(url, timeout=30)
+        rate_limiter.observe(response)
+        response.raise_for_status()
+        html = response.content.decode('utf-8', errors='ignore')
 
         parser = NCESDistrictParser()
         parser.feed(html)
@@ -205,9 +189,17 @@ def main():
 
     # Read CSV file
     with open(input_file, 'r', encoding='utf-8') as infile:
-        reader = csv.DictReader(infile)
+        rows = list(csv.DictReader(infile))
 
-        for i, row in enumerate(reader, start=1):
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Start every scrape, then report them in input order
+        scrapes = {}
+        for i, row in enumerate(rows, start=1):
+            nces = row.get('NCES', '').strip()
+            if row.get('District', '').strip() and nces:
+                scrapes[i] = executor.submit(scrape_nces_data, nces)
+
+        for i, row in enumerate(rows, start=1):
             district_name = row.get('District', '').strip()
             state = row.get('State', '').strip()
             qid = row.get('Qid', '').strip()
@@ -226,19 +218,16 @@ def main():
                 'NCES': nces
             }
 
-            # If NCES ID is available, scrape the data
+            # If NCES ID is available, use the scraped data
             if nces:
                 print(f"    Scraping NCES data for {nces}...")
-                nces_data = scrape_nces_data(nces)
+                nces_data = scrapes[i].result()
 
                 if nces_data:
                     district_data['nces_data'] = nces_data
                     print(f"    Successfully scraped data")
                 else:
                     print(f"    No data scraped")
-
-                # Rate limit
-                time.sleep(1)
             else:
                 print(f"    No NCES ID available")
 
@@ -4,113 +4,278 @@ Google Books Reconciliation Script
 Finds books without ISBNs, queries Google Books API, validates with Gemini, and updates records.
 """
 
-import json
+import hashlib
+import logging
+import orjson
 import os
 import re
-import time
+import sys
 import urllib.parse
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from google import genai
-from google.genai import types
+from google.genai import errors, types
+from pydantic import BaseModel
 
+from books_journal import append_update, apply_updates, checkpoint, close_journal, load_books
+from gemini_utils import MAX_RETRIES, RETRYABLE_STATUS_CODES, retry_delay_from_error
+from http_utils import rate_limiter_for, retrying_session
 
-def load_books():
-    """Load books from JSON file."""
-    with open('data/books_by_title.json', 'r') as f:
-        return json.load(f)
 
+log = logging.getLogger(__name__)
 
-def save_books(books):
-    """Save books to JSON file."""
-    with open('data/books_by_title.json', 'w') as f:
-        json.dump(books, f, indent=2)
+# Number of Google Books queries in flight at once, and how many books are
+# prefetched before their results are handled
+MAX_WORKERS = 8
+PREFETCH_CHUNK_SIZE = 200
+
+# Be nice to the Google Books API - cap the request rate across all workers
+REQUESTS_PER_SECOND = 5
+
+# Number of candidates validated in one Gemini request, and how many of each
+# candidate's Google Books results Gemini chooses from
+VALIDATION_BATCH_SIZE = 20
+VALIDATION_RESULTS = 3
+
+# Pace Gemini calls the way the old one-second sleep did
+GEMINI_REQUESTS_PER_SECOND = 1
+
+# Google Books responses from earlier runs, one JSON file per normalized (title, author),
+# and Gemini validations, one per (title, author) and the results Gemini was shown
+GB_CACHE_DIR = 'data/.gb_cache'
+VALIDATION_CACHE_DIR = 'data/.gemini_validation_cache'
+
+# Updated books are appended here as they happen; the full file is only rewritten
+# every CHECKPOINT_EVERY updates and at the end
+UPDATES_FILE = 'data/books_by_title.gb_reconcile.updates.jsonl'
+CHECKPOINT_EVERY = 50
+
+# Google Books is only ever read, so only GETs are retried
+SESSION = retrying_session(allowed_methods=['GET'])
+rate_limiter = rate_limiter_for('www.googleapis.com', REQUESTS_PER_SECOND)
+
+# Parenthetical text in a title, with the whitespace before it
+PARENTHETICAL_RE = re.compile(r'\s*\([^)]*\)')
 
 
 def clean_title(title):
     """Remove parenthetical text from title."""
-    return re.sub(r'\s*\([^)]*\)', '', title).strip()
+    return PARENTHETICAL_RE.sub('', title).strip()
 
 
 def get_author_lastname(author):
     """Extract last name from author string (format: 'Lastname, Firstname')."""
-    if ',' in author:
-        return author.split(',')[0].strip()
-    return author.strip()
+    return author.partition(',')[0].strip()
+
+
+def cache_key(title, author):
+    """Cache key for a (title, author) pair, normalized the same way as the Google Books query."""
+    key = f"{clean_title(title).lower()}|{get_author_lastname(author).lower()}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def load_cached_google_books(title, author):
+    """Return a cached Google Books response for a (title, author) pair, or None on a cache miss."""
+    cache_path = os.path.join(GB_CACHE_DIR, cache_key(title, author) + '.json')
+    if not os.path.exists(cache_path):
+        return None
+
+    with open(cache_path, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+def save_cached_google_books(title, author, data):
+    """Cache a Google Books response for a (title, author) pair."""
+    with open(os.path.join(GB_CACHE_DIR, cache_key(title, author) + '.json'), 'wb') as f:
+        f.write(orjson.dumps(data))
 
 
 def query_google_books(title, author):
-    """Query Google Books API for a book."""
+    """Query Google Books API for a book, reusing the response from an earlier run if cached."""
     clean_t = clean_title(title)
     author_last = get_author_lastname(author)
 
-    print(f"  [VERBOSE] Cleaned title: '{clean_t}'")
-    print(f"  [VERBOSE] Author last name: '{author_last}'")
+    log.debug("  Cleaned title: '%s'", clean_t)
+    log.debug("  Author last name: '%s'", author_last)
+
+    cached = load_cached_google_books(title, author)
+    if cached is not None:
+        log.debug("  Cached response: %s items found", cached.get('totalItems', 0))
+        return cached
 
     query = f"intitle:{clean_t}+inauthor:{author_last}"
     encoded_query = urllib.parse.quote(query)
     url = f"https://www.googleapis.com/books/v1/volumes?q={encoded_query}"
 
-    print(f"  [VERBOSE] Query URL: {url}")
+    log.debug("  Query URL: %s", url)
 
     try:
-        print(f"  [VERBOSE] Making request to Google Books API...")
-        with urllib.request.urlopen(url) as response:
-            data = json.loads(response.read().decode())
-            print(f"  [VERBOSE] Response received: {data.get('totalItems', 0)} items found")
-            return data
+        log.debug("  Making request to Google Books API...")
+        rate_limiter.wait()
+        response = SESSION.get(url, timeout=20)
+        rate_limiter.observe(response)
+        response.raise_for_status()
+        data = response.json()
+        log.debug("  Response received: %s items found", data.get('totalItems', 0))
+        # Only successful responses are cached, so errors are retried next run
+        save_cached_google_books(title, author, data)
+        return data
     except Exception as e:
         print(f"  [ERROR] Error querying Google Books: {e}")
         return None
 
 
-def validate_with_gemini(google_books_data, title, author):
-    """Use Gemini to validate if the Google Books result is a good match."""
-    print(f"  [VERBOSE] Validating with Gemini AI...")
+class Validation(BaseModel):
+    id: int
+    match: bool
+    item: int
+    reason_why: str
+
+
+GEMINI_MODEL = "gemini-flash-latest"
+
+# A yes/no match check needs no thinking budget
+VALIDATION_CONFIG = types.GenerateContentConfig(
+    temperature=0,
+    thinking_config=types.ThinkingConfig(thinking_budget=0),
+    response_mime_type="application/json",
+    response_schema=list[Validation],
+)
+
+gemini_limiter = rate_limiter_for('generativelanguage.googleapis.com', GEMINI_REQUESTS_PER_SECOND)
+
+
+def generate_with_retries(client, contents):
+    """Call Gemini, retrying rate limited and transient errors, and return the response."""
+    for attempt in range(MAX_RETRIES + 1):
+        gemini_limiter.wait()
+
+        try:
+            return client.models.generate_content(
+                model=GEMINI_MODEL,
+                contents=contents,
+                config=VALIDATION_CONFIG,
+            )
+        except errors.APIError as e:
+            if e.code not in RETRYABLE_STATUS_CODES or attempt == MAX_RETRIES:
+                raise
+
+            # The next wait() holds off until the delay has passed
+            delay = retry_delay_from_error(e) or 2 ** attempt
+            gemini_limiter.pause(delay)
+            print(f"  Gemini returned {e.code}, retrying in {delay:.0f}s...")
+
+
+def trim_google_books_data(google_books_data):
+    """
+    Keep only the fields Gemini needs to judge a match, for the top VALIDATION_RESULTS results.
+    Each is tagged with its index in google_books_data['items'].
+    """
+    trimmed = []
+    for i, item in enumerate((google_books_data.get('items') or [])[:VALIDATION_RESULTS]):
+        volume_info = item.get('volumeInfo', {})
+        trimmed.append({
+            'item': i,
+            'title': volume_info.get('title'),
+            'subtitle': volume_info.get('subtitle'),
+            'authors': volume_info.get('authors'),
+            'publishedDate': volume_info.get('publishedDate'),
+            'publisher': volume_info.get('publisher'),
+            'isbns': [
+                identifier.get('identifier')
+                for identifier in volume_info.get('industryIdentifiers', [])
+            ],
+        })
+    return trimmed
+
+
+def validation_cache_path(title, author, google_books_data):
+    """
+    Cache file for a Gemini validation. The verdict is about the Google Books
+    results it was shown, so they are part of the key along with (title, author).
+    """
+    candidate = orjson.dumps(trim_google_books_data(google_books_data))
+    key = hashlib.sha1(cache_key(title, author).encode() + b'|' + candidate).hexdigest()
+    return os.path.join(VALIDATION_CACHE_DIR, key + '.json')
+
+
+def load_cached_validation(title, author, google_books_data):
+    """Return a cached Gemini validation for a candidate, or None on a cache miss."""
+    cache_path = validation_cache_path(title, author, google_books_data)
+    if not os.path.exists(cache_path):
+        return None
 
-    client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+    with open(cache_path, 'rb') as f:
+        return orjson.loads(f.read())
 
-    prompt = f"""Is this data result from google books:
-{json.dumps(google_books_data, indent=2)}
 
-A good match for this record:
-{title} by {author}
+def save_cached_validation(title, author, google_books_data, validation):
+    """Cache a Gemini validation for a candidate."""
+    with open(validation_cache_path(title, author, google_books_data), 'wb') as f:
+        f.write(orjson.dumps(validation))
 
-Return JSON: {{"match":true/false, "reason_why":"short 1 sentence why or why not"}}"""
 
-    print(f"  [VERBOSE] Sending prompt to Gemini (length: {len(prompt)} chars)")
+def validate_with_gemini(candidates, client):
+    """
+    Use Gemini to validate whether each Google Books result is a good match, in one request.
+
+    Args:
+        candidates: List of (title, author, google_books_data)
+        client: Google GenAI client shared by all requests
+
+    Returns:
+        List of {"match", "item", "reason_why"} dicts aligned with candidates, with
+        None for any candidate missing from the response, or None if the request
+        itself failed
+    """
+    log.debug("  Validating %s candidates with Gemini AI...", len(candidates))
+
+    records = "\n\n".join(
+        f"""Record {i}: {title} by {author}
+Google Books results:
+{orjson.dumps(trim_google_books_data(google_books_data)).decode()}"""
+        for i, (title, author, google_books_data) in enumerate(candidates)
+    )
+
+    prompt = f"""For each of the following records, is one of the data results from google books a good match for the record?
+
+{records}
+
+Return a JSON array with one entry per record: [{{"id": record number, "match":true/false, "item": the "item" number of the matching result (0 if none match), "reason_why":"short 1 sentence why or why not"}}]"""
+
+    log.debug("  Sending prompt to Gemini (length: %s chars)", len(prompt))
 
-    model = "gemini-flash-latest"
     contents = [
         types.Content(
             role="user",
             parts=[types.Part.from_text(text=prompt)],
         ),
     ]
-    generate_content_config = types.GenerateContentConfig(
-        temperature=0,
-        thinking_config=types.ThinkingConfig(thinking_budget=-1),
-        response_mime_type="application/json",
-    )
 
     try:
-        response_text = ""
-        for chunk in client.models.generate_content_stream(
-            model=model,
-            contents=contents,
-            config=generate_content_config,
-        ):
-            response_text += chunk.text
-
-        print(f"  [VERBOSE] Gemini response received: {response_text}")
-        return json.loads(response_text)
+        response = generate_with_retries(client, contents)
     except Exception as e:
         print(f"  [ERROR] Error validating with Gemini: {e}")
         return None
 
+    validations = [None] * len(candidates)
+    try:
+        log.debug("  Gemini response received: %s", response.text)
+        for validation in response.parsed or []:
+            if 0 <= validation.id < len(candidates):
+                validations[validation.id] = {
+                    'match': validation.match,
+                    'item': validation.item,
+                    'reason_why': validation.reason_why,
+                }
+    except Exception as e:
+        print(f"  [ERROR] Error parsing Gemini response: {e}")
+
+    return validations
+
 
 def update_book_metadata(book_data, google_book_item, gemini_validation):
     """Update book metadata with information from Google Books."""
-    print(f"  [VERBOSE] Updating book metadata...")
+    log.debug("  Updating book metadata...")
 
     volume_info = google_book_item.get('volumeInfo', {})
 
@@ -121,70 +286,138 @@ def update_book_metadata(book_data, google_book_item, gemini_validation):
         if isbn:
             isbns.append(isbn)
 
-    print(f"  [VERBOSE] Extracted ISBNs: {isbns}")
+    log.debug("  Extracted ISBNs: %s", isbns)
 
     # Update metadata
     if isbns:
         book_data['metadata']['isbns'] = isbns
-        print(f"  [VERBOSE] Updated ISBNs field")
+        log.debug("  Updated ISBNs field")
 
     # Optionally update other fields if they're missing
     if not book_data['metadata'].get('publisher'):
         publisher = volume_info.get('publisher', '')
         book_data['metadata']['publisher'] = publisher
         if publisher:
-            print(f"  [VERBOSE] Added publisher: {publisher}")
+            log.debug("  Added publisher: %s", publisher)
 
     if not book_data['metadata'].get('publishedDate'):
         pub_date = volume_info.get('publishedDate', '')
         book_data['metadata']['publishedDate'] = pub_date
         if pub_date:
-            print(f"  [VERBOSE] Added published date: {pub_date}")
+            log.debug("  Added published date: %s", pub_date)
 
     if not book_data['metadata'].get('description'):
         description = volume_info.get('description', '')
         book_data['metadata']['description'] = description
         if description:
-            print(f"  [VERBOSE] Added description ({len(description)} chars)")
+            log.debug("  Added description (%s chars)", len(description))
 
     # Store Gemini validation response
     book_data['metadata']['gemini_validation'] = gemini_validation
-    print(f"  [VERBOSE] Stored Gemini validation response")
+    log.debug("  Stored Gemini validation response")
 
     return book_data
 
 
+def validate_and_update(books, pending, counts, updates_fp, client):
+    """
+    Validate a batch of Google Books candidates with Gemini, falling back to one
+    request per candidate for any a successful batch response left out, and
+    update the books that match.
+    """
+    print(f"\n[BATCH] Validating {len(pending)} candidates")
+
+    # Candidates validated by an earlier run don't need Gemini again
+    validations = [load_cached_validation(*candidate[1:]) for candidate in pending]
+    misses = [i for i, validation in enumerate(validations) if validation is None]
+    if misses:
+        fresh = validate_with_gemini([pending[i][1:] for i in misses], client)
+        batch_failed = fresh is None
+        if batch_failed:
+            # Already retried with backoff; sending each candidate alone would only add load
+            fresh = [None] * len(misses)
+
+        for i, validation in zip(misses, fresh):
+            if validation is None and not batch_failed and len(misses) > 1:
+                # Missing from the batch response, so one bad item doesn't fail the batch
+                print(f"  [RETRY] Validating Book ID {pending[i][0]} on its own")
+                validation = (validate_with_gemini([pending[i][1:]], client) or [None])[0]
+            if validation:
+                save_cached_validation(*pending[i][1:], validation)
+            validations[i] = validation
+
+    for (book_id, title, author, google_data), validation in zip(pending, validations):
+        print(f"\n  Book ID {book_id}: {title}")
+
+        if not validation:
+            print(f"  [RESULT] Failed to validate with Gemini")
+            counts['failed'] += 1
+            continue
+
+        print(f"  [GEMINI] Match: {validation.get('match')}")
+        print(f"  [GEMINI] Reason: {validation.get('reason_why')}")
+
+        # Only the results Gemini was shown can be the match
+        item = validation.get('item', 0)
+        if validation.get('match') and not 0 <= item < min(VALIDATION_RESULTS, len(google_data['items'])):
+            print(f"  [RESULT] Gemini matched result {item}, which it was not shown - skipping update")
+            counts['failed'] += 1
+        elif validation.get('match'):
+            # Update book metadata from the result Gemini matched
+            book_data = update_book_metadata(books[book_id], google_data['items'][item], validation)
+            books[book_id] = book_data
+            print(f"  [SUCCESS] Updated with ISBNs: {book_data['metadata']['isbns']}")
+            counts['updated'] += 1
+
+            # Record the update in the sidecar, and checkpoint the full file now and then
+            append_update(updates_fp, book_id, book_data)
+            if counts['updated'] % CHECKPOINT_EVERY == 0:
+                checkpoint(books, updates_fp)
+        else:
+            print(f"  [RESULT] Not a match - skipping update")
+            counts['failed'] += 1
+
+
 def main():
     """Main execution function."""
-    print("[VERBOSE] Starting Google Books reconciliation script...")
-    print("[VERBOSE] Loading books from data/books_by_title.json...")
+    # Per-request detail is logged at DEBUG; run with LOGLEVEL=DEBUG to see it
+    logging.basicConfig(
+        level=os.environ.get('LOGLEVEL', 'INFO').upper(),
+        format='%(message)s',
+        stream=sys.stdout,
+    )
+
+    log.info("Starting Google Books reconciliation script...")
+    log.info("Loading books from data/books_by_title.json...")
+
+    # One Gemini client, shared by every validation request
+    client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
 
     books = load_books()
     total_books = len(books)
-    print(f"[VERBOSE] Loaded {total_books} books total")
+    log.info("Loaded %s books total", total_books)
 
-    # Count books without ISBNs
-    books_without_isbns = 0
-    for book_data in books.values():
-        metadata = book_data.get('metadata', {})
-        isbns = metadata.get('isbns', [])
-        if not isbns or len(isbns) == 0:
-            books_without_isbns += 1
-
-    print(f"[VERBOSE] Found {books_without_isbns} books without ISBNs")
-    print("\n" + "="*80 + "\n")
+    # Recover updates from a previous run that did not finish
+    recovered = apply_updates(books, UPDATES_FILE)
+    if recovered:
+        log.info("Recovered %s updates from %s", recovered, UPDATES_FILE)
 
     processed_count = 0
-    updated_count = 0
     skipped_count = 0
-    failed_count = 0
+    counts = {'updated': 0, 'failed': 0}
+    os.makedirs(GB_CACHE_DIR, exist_ok=True)
+    os.makedirs(VALIDATION_CACHE_DIR, exist_ok=True)
+
+    # Candidates waiting for Gemini validation: (book_id, title, author, google_data)
+    pending = []
 
+    # Build the work queue in one pass: books without ISBNs that have a title and author
+    work = []
     for book_id, book_data in books.items():
         metadata = book_data.get('metadata', {})
-        isbns = metadata.get('isbns', [])
 
         # Skip if already has ISBNs
-        if isbns and len(isbns) > 0:
+        if metadata.get('isbns'):
             continue
 
         title = metadata.get('title', '')
@@ -195,55 +428,56 @@ def main():
             skipped_count += 1
             continue
 
-        processed_count += 1
-        print(f"\n[{processed_count}/{books_without_isbns}] Processing Book ID: {book_id}")
-        print(f"  Title: {title}")
-        print(f"  Author: {author}")
+        work.append((book_id, title, author))
 
-        # Query Google Books
-        google_data = query_google_books(title, author)
-        if not google_data or google_data.get('totalItems', 0) == 0:
-            print(f"  [RESULT] No results found in Google Books")
-            failed_count += 1
-            continue
-
-        # Get first result
-        first_item = google_data['items'][0]
-        google_title = first_item.get('volumeInfo', {}).get('title', 'N/A')
-        google_authors = first_item.get('volumeInfo', {}).get('authors', [])
-        print(f"  [VERBOSE] First Google Books result:")
-        print(f"    - Title: {google_title}")
-        print(f"    - Authors: {', '.join(google_authors)}")
-
-        # Validate with Gemini
-        validation = validate_with_gemini(google_data, title, author)
-        if not validation:
-            print(f"  [RESULT] Failed to validate with Gemini")
-            failed_count += 1
-            continue
-
-        print(f"  [GEMINI] Match: {validation.get('match')}")
-        print(f"  [GEMINI] Reason: {validation.get('reason_why')}")
-
-        if validation.get('match'):
-            # Update book metadata
-            book_data = update_book_metadata(book_data, first_item, validation)
-            books[book_id] = book_data
-            print(f"  [SUCCESS] Updated with ISBNs: {book_data['metadata']['isbns']}")
-            updated_count += 1
-
-            # Save after each successful update
-            print(f"  [VERBOSE] Saving to disk...")
-            save_books(books)
-            print(f"  [VERBOSE] Save complete")
-        else:
-            print(f"  [RESULT] Not a match - skipping update")
-            failed_count += 1
+    books_without_isbns = len(work) + skipped_count
+    log.info("Found %s books without ISBNs", books_without_isbns)
+    print("\n" + "="*80 + "\n")
 
-        # Rate limiting - be nice to the APIs
-        print(f"  [VERBOSE] Waiting 1 second before next request...")
-        time.sleep(1)
-        print("\n" + "-"*80)
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    updates_fp = open(UPDATES_FILE, 'ab')
+    try:
+        # Fetch Google Books results a chunk at a time, concurrently, and handle them in order
+        for start in range(0, len(work), PREFETCH_CHUNK_SIZE):
+            chunk = work[start:start + PREFETCH_CHUNK_SIZE]
+            results = executor.map(lambda item: query_google_books(item[1], item[2]), chunk)
+
+            for processed_count, ((book_id, title, author), google_data) in enumerate(zip(chunk, results), start + 1):
+                print(f"\n[{processed_count}/{len(work)}] Processing Book ID: {book_id}")
+                print(f"  Title: {title}")
+                print(f"  Author: {author}")
+
+                if not google_data or google_data.get('totalItems', 0) == 0:
+                    print(f"  [RESULT] No results found in Google Books")
+                    counts['failed'] += 1
+                    continue
+
+                # Get first result
+                first_item = google_data['items'][0]
+                google_title = first_item.get('volumeInfo', {}).get('title', 'N/A')
+                google_authors = first_item.get('volumeInfo', {}).get('authors', [])
+                log.debug("  First Google Books result:")
+                log.debug("    - Title: %s", google_title)
+                log.debug("    - Authors: %s", ', '.join(google_authors))
+
+                # Queue for validation with Gemini
+                pending.append((book_id, title, author, google_data))
+                if len(pending) >= VALIDATION_BATCH_SIZE:
+                    validate_and_update(books, pending, counts, updates_fp, client)
+                    pending = []
+
+                print("\n" + "-"*80)
+
+        if pending:
+            validate_and_update(books, pending, counts, updates_fp, client)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+        # Write the full file once with everything in the sidecar
+        close_journal(books, updates_fp, UPDATES_FILE)
+
+    updated_count = counts['updated']
+    failed_count = counts['failed']
 
     print("\n" + "="*80)
     print("[COMPLETE] Reconciliation complete!")
@@ -0,0 +1,25 @@
+"""
+Gemini helpers shared by the scripts that call it: which errors to retry and
+how long the API asks us to wait.
+"""
+
+
+# Retries for rate limited or transient server errors
+MAX_RETRIES = 3
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def retry_delay_from_error(error):
+    """Return the retry delay in seconds suggested by a Gemini API error, if any."""
+    if not isinstance(error.details, dict):
+        return None
+
+    for detail in error.details.get('error', {}).get('details', []):
+        delay = detail.get('retryDelay')
+        if isinstance(delay, str) and delay.endswith('s'):
+            try:
+                return float(delay[:-1])
+            except ValueError:
+                pass
+
+    return None
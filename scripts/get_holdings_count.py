@@ -4,65 +4,133 @@ OCLC Holdings Count Script
 Tests the WorldCat holdings endpoint to get library holdings information.
 """
 
-import json
+import ijson
+import logging
 import os
-import requests
+import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+from books_journal import append_update, apply_updates, checkpoint, close_journal, load_books
+from http_utils import rate_limiter_for, retrying_session
+
+
+log = logging.getLogger(__name__)
+
+# Updated books are appended here as they happen; the full file is only rewritten
+# every CHECKPOINT_EVERY updates and at the end
+UPDATES_FILE = 'data/books_by_title.get_holdings_count.updates.jsonl'
+CHECKPOINT_EVERY = 50
+
+# Books looked up at once, and OCLC number lookups in flight at once
+BOOK_WORKERS = 8
+LOOKUP_WORKERS = 16
+
+# Be nice to the OCLC API - cap the request rate across all workers
+REQUESTS_PER_SECOND = 5
+
+# One keep-alive connection per concurrent lookup
+SESSION = retrying_session(pool_maxsize=LOOKUP_WORKERS)
+rate_limiter = rate_limiter_for('americas.discovery.api.oclc.org', REQUESTS_PER_SECOND)
+
+# OCLC tokens last 1199 seconds; refresh a minute before that
+TOKEN_LIFETIME = 1199
+TOKEN_REFRESH_MARGIN = 60
 
 # Global variables for authentication
 headers = {}
-auth_timestamp = None
+token_deadline = None  # time.monotonic() after which the token must be refreshed
+auth_lock = threading.Lock()
 
 
 def reauth(oclc_client_id, oclc_secret):
     """Authenticate with OCLC API."""
     global headers
-    global auth_timestamp
-
-    if auth_timestamp is not None:
-        sec_left = time.time() - auth_timestamp
-        sec_left = 1199 - 1 - int(sec_left)
+    global token_deadline
 
-        if sec_left > 60:
+    # Worker threads share one token, so only one of them refreshes it at a time
+    with auth_lock:
+        if token_deadline is not None and time.monotonic() < token_deadline:
             return True
 
-    print("[VERBOSE] Authenticating with OCLC...")
-    response = requests.post(
-        'https://oauth.oclc.org/token',
-        data={"grant_type": "client_credentials", 'scope': ['wcapi']},
-        auth=(oclc_client_id, oclc_secret),
-    )
+        log.debug("Authenticating with OCLC...")
+        response = SESSION.post(
+            'https://oauth.oclc.org/token',
+            data={"grant_type": "client_credentials", 'scope': ['wcapi']},
+            auth=(oclc_client_id, oclc_secret),
+            timeout=30,
+        )
 
-    print(f"[VERBOSE] Auth response: {response.text}")
+        log.debug("Auth response: %s", response.text)
 
-    response_data = response.json()
-    if "access_token" not in response_data:
-        print("[ERROR] access token not found (BAD KEY/SECRET?)")
-        return False
+        response_data = response.json()
+        if "access_token" not in response_data:
+            print("[ERROR] access token not found (BAD KEY/SECRET?)")
+            return False
 
-    token = response_data["access_token"]
-    auth_timestamp = time.time()
+        token = response_data["access_token"]
+        lifetime = response_data.get("expires_in", TOKEN_LIFETIME)
+        token_deadline = time.monotonic() + lifetime - TOKEN_REFRESH_MARGIN
 
-    headers = {
-        'accept': 'application/json',
-        'Authorization': f'Bearer {token}'
-    }
-    print("[VERBOSE] Authentication successful")
+        headers = {
+            'accept': 'application/json',
+            'Authorization': f'Bearer {token}'
+        }
+        log.debug("Authentication successful")
 
     return True
 
 
+# Fields kept from the first brief record's institutionHolding
+HOLDING_PREFIXES = {
+    'briefRecords.item.institutionHolding.totalHoldingCount': 'totalHoldingCount',
+    'briefRecords.item.institutionHolding.totalEditions': 'totalEditions',
+}
+
+
+def parse_holdings(stream):
+    """
+    Stream-parse a holdings response, keeping only the first brief record's
+    holding totals. Returns {"totalHoldingCount", "totalEditions"}, or None if
+    there are no records.
+    """
+    number_of_records = None
+    brief_records_seen = 0
+    institution_holding = {}
+
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if prefix == 'numberOfRecords':
+            number_of_records = value
+        elif prefix == 'briefRecords.item':
+            if event == 'start_map':
+                brief_records_seen += 1
+            elif event == 'end_map' and number_of_records is not None:
+                # The rest of the brief records are never used (the caller drains them)
+                break
+        elif prefix in HOLDING_PREFIXES and brief_records_seen == 1:
+            institution_holding[HOLDING_PREFIXES[prefix]] = value
+
+    if not number_of_records or not brief_records_seen:
+        return None
+
+    return {
+        'totalHoldingCount': institution_holding.get('totalHoldingCount'),
+        'totalEditions': institution_holding.get('totalEditions'),
+    }
+
+
 def get_holdings_count(oclc_number, oclc_client_id, oclc_secret):
     """Get holdings count for an OCLC number."""
-    global headers
-
     # Check if we need to reauth
     reauth_okay = reauth(oclc_client_id, oclc_secret)
 
     if not reauth_okay:
         return None
 
+    # reauth replaces headers wholesale, so this reference stays consistent
+    request_headers = headers
+
     url = f'https://americas.discovery.api.oclc.org/worldcat/search/v2/bibs-summary-holdings'
 
     params = {
@@ -70,20 +138,31 @@ def get_holdings_count(oclc_number, oclc_client_id, oclc_secret):
         'holdingsAllEditions': 'true'
     }
 
-    print(f"  [VERBOSE] Querying holdings with URL: {url}")
-    print(f"  [VERBOSE] Query params: {params}")
+    log.debug("  Querying holdings with URL: %s", url)
+    log.debug("  Query params: %s", params)
 
     try:
-        response = requests.get(url, headers=headers, params=params)
-        print(f"  [VERBOSE] Response status: {response.status_code}")
+        rate_limiter.wait()
+        with SESSION.get(url, headers=request_headers, params=params, timeout=30, stream=True) as response:
+            rate_limiter.observe(response)
+            log.debug("  Response status: %s", response.status_code)
+
+            # Auth errors, or rate limits that outlasted the retries, are failures, not "no holdings"
+            response.raise_for_status()
+
+            # Parse straight off the socket instead of buffering the whole body
+            response.raw.decode_content = True
+            data = parse_holdings(response.raw)
 
-        data = response.json()
+            # parse_holdings stops early; read off the rest of the body so the
+            # connection goes back to the keep-alive pool instead of being closed
+            response.raw.drain_conn()
 
         # Check if we got valid results
-        if data.get('numberOfRecords', 0) > 0 and 'briefRecords' in data:
+        if data:
             return data
         else:
-            print(f"  [VERBOSE] No holdings data returned")
+            log.debug("  No holdings data returned")
             return None
 
     except Exception as e:
@@ -91,20 +170,39 @@ def get_holdings_count(oclc_number, oclc_client_id, oclc_secret):
         return None
 
 
-def load_books():
-    """Load books from JSON file."""
-    with open('data/books_by_title.json', 'r') as f:
-        return json.load(f)
+def find_holdings(oclc_numbers, executor, oclc_client_id, oclc_secret):
+    """
+    Get holdings for all OCLC numbers of a book concurrently.
+    Returns (oclc_number, holdings) for the first number in list order with data, or (None, None).
+    """
+    futures = [
+        executor.submit(get_holdings_count, oclc_num, oclc_client_id, oclc_secret)
+        for oclc_num in oclc_numbers
+    ]
 
+    try:
+        for oclc_num, future in zip(oclc_numbers, futures):
+            holdings_data = future.result()
+            if holdings_data:
+                return oclc_num, holdings_data
+            log.debug("  No holdings data for OCLC number: %s", oclc_num)
+    finally:
+        # Drop lookups that have not started once we have an answer
+        for future in futures:
+            future.cancel()
 
-def save_books(books):
-    """Save books to JSON file."""
-    with open('data/books_by_title.json', 'w') as f:
-        json.dump(books, f, indent=2)
+    return None, None
 
 
 def main():
     """Main execution function."""
+    # Per-request detail is logged at DEBUG; run with LOGLEVEL=DEBUG to see it
+    logging.basicConfig(
+        level=os.environ.get('LOGLEVEL', 'INFO').upper(),
+        format='%(message)s',
+        stream=sys.stdout,
+    )
+
     # Get OCLC credentials from environment
     oclc_client_id = os.environ.get('OCLC_CLIENT_ID')
     oclc_secret = os.environ.get('OCLC_SECRET')
@@ -118,87 +216,82 @@ def main():
     print("="*80)
     print()
 
-    print("[VERBOSE] Loading books from data/books_by_title.json...")
+    log.info("Loading books from data/books_by_title.json...")
     books = load_books()
     total_books = len(books)
-    print(f"[VERBOSE] Loaded {total_books} books total")
-
-    # Count books with OCLC numbers that need holdings data
-    books_needing_holdings = 0
-    for book_data in books.values():
-        metadata = book_data.get('metadata', {})
-        oclc_numbers = metadata.get('oclc_numbers', [])
-        has_holdings = 'holdings' in metadata
+    log.info("Loaded %s books total", total_books)
 
-        if oclc_numbers and not has_holdings:
-            books_needing_holdings += 1
-
-    print(f"[VERBOSE] Found {books_needing_holdings} books with OCLC numbers but no holdings data")
-    print("\n" + "="*80 + "\n")
+    # Recover updates from a previous run that did not finish
+    recovered = apply_updates(books, UPDATES_FILE)
+    if recovered:
+        log.info("Recovered %s updates from %s", recovered, UPDATES_FILE)
 
     processed_count = 0
     updated_count = 0
     skipped_count = 0
     failed_count = 0
 
-    for book_id, book_data in books.items():
-        metadata = book_data.get('metadata', {})
-        oclc_numbers = metadata.get('oclc_numbers', [])
-        has_holdings = 'holdings' in metadata
+    # Build the work queue in one pass: books with OCLC numbers but no holdings
+    work = [
+        (book_id, book_data)
+        for book_id, book_data in books.items()
+        if book_data.get('metadata', {}).get('oclc_numbers') and 'holdings' not in book_data['metadata']
+    ]
 
-        # Skip if no OCLC numbers or already has holdings
-        if not oclc_numbers or has_holdings:
-            continue
-
-        title = metadata.get('title', 'N/A')
-        author = metadata.get('author', 'N/A')
-
-        processed_count += 1
-        print(f"\n[{processed_count}/{books_needing_holdings}] Processing Book ID: {book_id}")
-        print(f"  Title: {title}")
-        print(f"  Author: {author}")
-        print(f"  OCLC numbers available: {len(oclc_numbers)}")
-
-        # Try each OCLC number until we get holdings data
-        holdings_data = None
-        for idx, oclc_num in enumerate(oclc_numbers):
-            print(f"  [VERBOSE] Trying OCLC number {idx + 1}/{len(oclc_numbers)}: {oclc_num}")
+    books_needing_holdings = len(work)
+    log.info("Found %s books with OCLC numbers but no holdings data", books_needing_holdings)
+    print("\n" + "="*80 + "\n")
 
-            holdings_data = get_holdings_count(oclc_num, oclc_client_id, oclc_secret)
+    # Books are looked up concurrently, each trying all its OCLC numbers at once
+    book_executor = ThreadPoolExecutor(max_workers=BOOK_WORKERS)
+    lookup_executor = ThreadPoolExecutor(max_workers=LOOKUP_WORKERS)
+    updates_fp = open(UPDATES_FILE, 'ab')
+    try:
+        lookups = book_executor.map(
+            lambda item: find_holdings(item[1]['metadata']['oclc_numbers'], lookup_executor, oclc_client_id, oclc_secret),
+            work,
+        )
+
+        for processed_count, ((book_id, book_data), (oclc_num, holdings_data)) in enumerate(zip(work, lookups), 1):
+            metadata = book_data['metadata']
+            oclc_numbers = metadata['oclc_numbers']
+            title = metadata.get('title', 'N/A')
+            author = metadata.get('author', 'N/A')
+
+            print(f"\n[{processed_count}/{books_needing_holdings}] Processing Book ID: {book_id}")
+            print(f"  Title: {title}")
+            print(f"  Author: {author}")
+            print(f"  OCLC numbers available: {len(oclc_numbers)}")
 
             if holdings_data:
                 print(f"  [SUCCESS] Got holdings data for OCLC number: {oclc_num}")
-                if 'briefRecords' in holdings_data and holdings_data['briefRecords']:
-                    brief_record = holdings_data['briefRecords'][0]
-                    if 'institutionHolding' in brief_record:
-                        total_count = brief_record['institutionHolding'].get('totalHoldingCount', 'N/A')
-                        total_editions = brief_record['institutionHolding'].get('totalEditions', 'N/A')
-                        print(f"    - Total Holdings: {total_count}")
-                        print(f"    - Total Editions: {total_editions}")
-                break
+                print(f"    - Total Holdings: {holdings_data['totalHoldingCount']}")
+                print(f"    - Total Editions: {holdings_data['totalEditions']}")
+
+                # Store just the totals downstream scripts use, and where they came from
+                metadata['holdings'] = {
+                    'totalHoldingCount': holdings_data['totalHoldingCount'],
+                    'totalEditions': holdings_data['totalEditions'],
+                    'oclcNumber': oclc_num,
+                    'fetched_at': int(time.time()),
+                }
+                updated_count += 1
+
+                # Record the update in the sidecar, and checkpoint the full file now and then
+                append_update(updates_fp, book_id, book_data)
+                if updated_count % CHECKPOINT_EVERY == 0:
+                    checkpoint(books, updates_fp)
             else:
-                print(f"  [VERBOSE] No holdings data for OCLC number: {oclc_num}")
-
-            # Small delay between requests
-            time.sleep(0.5)
+                print(f"  [RESULT] No holdings data found for any OCLC number")
+                failed_count += 1
 
-        if holdings_data:
-            # Store holdings data in metadata
-            metadata['holdings'] = holdings_data
-            updated_count += 1
-
-            # Save after each successful update
-            print(f"  [VERBOSE] Saving to disk...")
-            save_books(books)
-            print(f"  [VERBOSE] Save complete")
-        else:
-            print(f"  [RESULT] No holdings data found for any OCLC number")
-            failed_count += 1
+            print("\n" + "-"*80)
+    finally:
+        book_executor.shutdown(cancel_futures=True)
+        lookup_executor.shutdown(cancel_futures=True)
 
-        # Rate limiting
-        print(f"  [VERBOSE] Waiting 1 second before next request...")
-        time.sleep(1)
-        print("\n" + "-"*80)
+        # Write the full file once with everything in the sidecar
+        close_journal(books, updates_fp, UPDATES_FILE)
 
     print("\n" + "="*80)
     print("[COMPLETE] Holdings count script complete!")
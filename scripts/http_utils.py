@@ -0,0 +1,95 @@
+"""
+HTTP helpers shared by the network scripts: a retrying keep-alive session and
+a per-host rate limiter.
+"""
+
+import requests
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+USER_AGENT = 'user: thisismattmiller - data scripts'
+
+# X-RateLimit-Reset values above this are epoch timestamps, not seconds from now
+EPOCH_THRESHOLD = 1_000_000_000
+
+
+def retrying_session(pool_maxsize=10, status_forcelist=(429, 500, 502, 503, 504),
+                     allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, user_agent=None):
+    """
+    Session with pooled keep-alive connections that retries (honouring
+    Retry-After) with backoff on rate limits and server errors.
+    """
+    session = requests.Session()
+    if user_agent:
+        session.headers.update({'User-Agent': user_agent})
+    session.mount('https://', HTTPAdapter(
+        pool_connections=pool_maxsize,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=list(status_forcelist),
+            allowed_methods=allowed_methods,
+        ),
+    ))
+    return session
+
+
+class RateLimiter:
+    """
+    Space requests at least 1/rate seconds apart across all threads, and pause
+    them all when a response says the server's limit has been reached.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next request slot."""
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def observe(self, response):
+        """Hold every thread off when the server's rate-limit headers say to."""
+        retry_after = response.headers.get('Retry-After', '')
+        remaining = response.headers.get('X-RateLimit-Remaining', '')
+        reset = response.headers.get('X-RateLimit-Reset', '')
+
+        if retry_after.isdigit():
+            pause = int(retry_after)
+        elif remaining.isdigit() and int(remaining) <= 1:
+            # Reset is either seconds from now or an epoch timestamp
+            pause = int(reset) if reset.isdigit() else 1
+            if pause > EPOCH_THRESHOLD:
+                pause = max(0, pause - time.time())
+        else:
+            return
+
+        self.pause(pause)
+
+    def pause(self, seconds):
+        """Hold every thread off for the next `seconds` seconds."""
+        with self.lock:
+            self.next_time = max(self.next_time, time.monotonic() + seconds)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def rate_limiter_for(host, rate):
+    """Return the RateLimiter for a host, creating it at the given rate on first use."""
+    with _rate_limiters_lock:
+        if host not in _rate_limiters:
+            _rate_limiters[host] = RateLimiter(rate)
+        return _rate_limiters[host]
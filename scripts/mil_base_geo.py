@@ -5,9 +5,16 @@ Fetch geolocation data for military bases using Google Places API.
 
 import os
 import json
+import logging
 import requests
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional
 
+from http_utils import retrying_session
+
+
+log = logging.getLogger(__name__)
 
 MILITARY_BASES = [
     "Marine Corps Base Camp Lejeune, NC",
@@ -30,6 +37,10 @@ MILITARY_BASES = [
 ]
 
 
+# Text Search only reads, so its POSTs are safe to retry
+SESSION = retrying_session(pool_maxsize=16, allowed_methods=["POST"])
+
+
 def get_place_details(base_name: str, api_key: str) -> Optional[Dict]:
     """
     Fetch place details from Google Places API (New) for a given military base.
@@ -55,12 +66,13 @@ def get_place_details(base_name: str, api_key: str) -> Optional[Dict]:
     }
 
     try:
-        response = requests.post(search_url, headers=headers, json=body)
+        response = SESSION.post(search_url, headers=headers, json=body, timeout=20)
         response.raise_for_status()
         data = response.json()
 
-        print(f"\nDEBUG - Response for '{base_name}':")
-        print(f"  Full response: {json.dumps(data, indent=2)}")
+        # Skip pretty-printing the whole response unless it will be shown
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("\nResponse for '%s':\n  Full response: %s", base_name, json.dumps(data, indent=2))
 
         if "places" not in data or len(data["places"]) == 0:
             print(f"✗ No results found for: {base_name}")
@@ -96,6 +108,13 @@ def get_place_details(base_name: str, api_key: str) -> Optional[Dict]:
 
 def main():
     """Main function to fetch all military base locations."""
+    # Per-request detail is logged at DEBUG; run with LOGLEVEL=DEBUG to see it
+    logging.basicConfig(
+        level=os.environ.get("LOGLEVEL", "INFO").upper(),
+        format="%(message)s",
+        stream=sys.stdout,
+    )
+
     api_key = os.getenv("GOOGLE_PLACES_API_KEY")
 
     if not api_key:
@@ -103,20 +122,32 @@ def main():
         print("Please set it with: export GOOGLE_PLACES_API_KEY='your-api-key'")
         return
 
-    results = []
+    output_path = "data/mil_bases.json"
+
+    # Bases resolved by an earlier run are kept as-is, so reruns only look up new ones
+    done = {}
+    if os.path.exists(output_path):
+        with open(output_path, "r") as f:
+            done = {place["name"]: place for place in json.load(f)}
+
+    todo = [base for base in dict.fromkeys(MILITARY_BASES) if base not in done]
 
-    print(f"Fetching geolocation data for {len(MILITARY_BASES)} military bases...\n")
+    print(f"Fetching geolocation data for {len(todo)} military bases ({len(done)} already resolved)...\n")
 
-    for base in MILITARY_BASES:
-        place_data = get_place_details(base, api_key)
-        if place_data:
-            results.append(place_data)
+    # Look up the remaining bases at once; map keeps results in MILITARY_BASES order
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for place_data in executor.map(lambda base: get_place_details(base, api_key), todo):
+            if place_data:
+                done[place_data["name"]] = place_data
+
+    # Write bases in MILITARY_BASES order, followed by any others from earlier runs
+    results = [done[base] for base in dict.fromkeys(MILITARY_BASES) if base in done]
+    results.extend(place for name, place in done.items() if name not in MILITARY_BASES)
 
     # Ensure data directory exists
     os.makedirs("data", exist_ok=True)
 
     # Write results to JSON file
-    output_path = "data/mil_bases.json"
     with open(output_path, "w") as f:
         json.dump(results, f, indent=2)
 
@@ -1,14 +1,13 @@
 #!/usr/bin/env python3
-import json
+import ijson
 
-with open('data/books_by_title.json', 'r') as f:
-    books = json.load(f)
+# Stream (book_id, book_data) pairs instead of loading the whole file
+with open('data/books_by_title.json', 'rb') as f:
+    for book_id, book_data in ijson.kvitems(f, '', use_float=True):
+        metadata = book_data.get('metadata', {})
+        isbns = metadata.get('isbns', [])
 
-for book_id, book_data in books.items():
-    metadata = book_data.get('metadata', {})
-    isbns = metadata.get('isbns', [])
-
-    if not isbns or len(isbns) == 0:
-        title = metadata.get('title', 'N/A')
-        author = metadata.get('author', 'N/A')
-        print(f"{title} by {author}")
+        if not isbns or len(isbns) == 0:
+            title = metadata.get('title', 'N/A')
+            author = metadata.get('author', 'N/A')
+            print(f"{title} by {author}")